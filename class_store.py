@@ -0,0 +1,273 @@
+import contextlib
+import datetime
+import pandas as pd
+from state_store import StateStore
+
+REGISTER_TOKEN = "v"
+REMOVAL_TOKEN = "x"
+DEFAULT_REGISTRATION_ID = -1
+RELEVANT_COLS = [
+    "id",
+    "dateRequest",
+    "description",
+    "startTime",
+    "endTime",
+    "registered",
+    "registrationId",
+    # blank for the branch of the config, see FizikalManager.branch_ids
+    "branchId",
+]
+# columns that identify the same class occurrence across schedule refreshes
+SCHEDULE_COLS = [c for c in RELEVANT_COLS if "regis" not in c]
+
+
+class ClassRecord:
+    __slots__ = RELEVANT_COLS
+
+    def __init__(
+        self,
+        id,
+        dateRequest,
+        description="",
+        startTime="",
+        endTime="",
+        registered=REMOVAL_TOKEN,
+        registrationId=DEFAULT_REGISTRATION_ID,
+        branchId=None,
+    ):
+        self.id = int(id)
+        self.dateRequest = str(dateRequest)
+        self.description = description
+        self.startTime = startTime
+        self.endTime = endTime
+        self.registered = registered
+        self.registrationId = registrationId
+        self.branchId = _branch_id(branchId)
+
+    @property
+    def key(self) -> tuple:
+        return (self.id, self.dateRequest, self.branchId)
+
+    @property
+    def as_date(self) -> datetime.date:
+        return datetime.date(*[int(d) for d in self.dateRequest.split("-")])
+
+    @property
+    def start(self) -> datetime.datetime:
+        h, m = self.startTime.split(":")
+        return datetime.datetime.combine(
+            self.as_date, datetime.time(hour=int(h), minute=int(m))
+        )
+
+    def same_occurrence(self, other) -> bool:
+        return all(getattr(self, c) == getattr(other, c) for c in SCHEDULE_COLS)
+
+    def values(self) -> list:
+        return [getattr(self, c) for c in RELEVANT_COLS]
+
+
+def _registration_id(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_REGISTRATION_ID
+
+
+def _token(value) -> str:
+    return value if value in (REGISTER_TOKEN, REMOVAL_TOKEN) else REMOVAL_TOKEN
+
+
+def _branch_id(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def frame_key(row: pd.DataFrame) -> tuple:
+    """
+    Store key of a one-row frame
+    """
+    branch = row["branchId"].values[0] if "branchId" in row else None
+    return (
+        int(row["id"].values[0]),
+        str(row["dateRequest"].values[0]),
+        _branch_id(branch),
+    )
+
+
+class ClassStore:
+    """
+    In-memory class state keyed by (id, dateRequest, branchId).
+    Keeps secondary indexes on the registered token and on registrationId so
+    lookups and state transitions don't scan the whole schedule.
+    Records must only be changed through set_registration to keep the
+    indexes in sync.
+    With a StateStore every change is written through to it, bulk changes
+    in one transaction, and load() restores the state after a restart.
+    """
+
+    def __init__(self, store: StateStore = None):
+        self.store = store
+        self.records = dict()
+        self.by_token = {REGISTER_TOKEN: set(), REMOVAL_TOKEN: set()}
+        self.by_registration_id = dict()
+
+    def transaction(self):
+        if self.store is None:
+            return contextlib.nullcontext()
+        return self.store.transaction()
+
+    def load(self):
+        """
+        Replaces the in-memory state with the store's
+        """
+        self._clear_memory()
+        for row in self.store.load_classes():
+            record = ClassRecord(**row)
+            self.records[record.key] = record
+            self._index(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    @property
+    def empty(self) -> bool:
+        return not self.records
+
+    def get(self, key) -> ClassRecord:
+        return self.records.get(key)
+
+    def _index(self, record: ClassRecord):
+        self.by_token[record.registered].add(record.key)
+        if record.registrationId > DEFAULT_REGISTRATION_ID:
+            self.by_registration_id[record.registrationId] = record.key
+
+    def _unindex(self, record: ClassRecord):
+        self.by_token[record.registered].discard(record.key)
+        self.by_registration_id.pop(record.registrationId, None)
+
+    def add(self, record: ClassRecord):
+        old = self.records.get(record.key)
+        if old is not None:
+            self._unindex(old)
+        self.records[record.key] = record
+        self._index(record)
+        if self.store is not None:
+            self.store.put_class(record)
+
+    def remove(self, key):
+        record = self.records.pop(key, None)
+        if record is not None:
+            self._unindex(record)
+            if self.store is not None:
+                self.store.delete_class(key)
+
+    def _clear_memory(self):
+        self.records.clear()
+        for keys in self.by_token.values():
+            keys.clear()
+        self.by_registration_id.clear()
+
+    def clear(self):
+        self._clear_memory()
+        if self.store is not None:
+            self.store.delete_classes()
+
+    def set_registration(self, key, registered=None, registration_id=None):
+        record = self.records[key]
+        self._unindex(record)
+        if registered is not None:
+            record.registered = registered
+        if registration_id is not None:
+            record.registrationId = int(registration_id)
+        self._index(record)
+        if self.store is not None:
+            self.store.set_registration(key, record.registered, record.registrationId)
+
+    def registered(self) -> list:
+        """
+        Classes we hold a registration for
+        """
+        return [self.records[key] for key in self.by_registration_id.values()]
+
+    def wanted_or_registered(self) -> list:
+        """
+        Classes in which we are either registered or want to register
+        """
+        keys = self.by_token[REGISTER_TOKEN] | set(self.by_registration_id.values())
+        return [self.records[key] for key in keys]
+
+    def apply_sheet(self, df: pd.DataFrame):
+        """
+        Applies a sheet snapshot. The sheet is a view of the store in which
+        the wanted classes are marked, so of the classes we know only the
+        registered token is taken; unknown rows are added as they are.
+        """
+        # sheets from before the branch column are all of the config's branch
+        required = [c for c in SCHEDULE_COLS if c != "branchId"]
+        if df.empty or not set(required).issubset(df.columns):
+            return
+        with self.transaction():
+            for row in df.to_dict("records"):
+                record = ClassRecord(
+                    **{c: row[c] for c in required},
+                    registered=_token(row.get("registered")),
+                    registrationId=_registration_id(row.get("registrationId")),
+                    branchId=row.get("branchId"),
+                )
+                old = self.records.get(record.key)
+                if old is None:
+                    self.add(record)
+                elif old.registered != record.registered:
+                    self.set_registration(old.key, record.registered)
+
+    def merge_schedule(self, classes: list, keep_days=()):
+        """
+        Replaces the schedule with freshly fetched classes, keeping the
+        registration state of occurrences we already knew.
+        Known classes of keep_days, (dateRequest, branchId) pairs whose fetch
+        failed, are kept as is.
+        """
+        previous = dict(self.records)
+        with self.transaction():
+            self.clear()
+            for c in classes:
+                record = ClassRecord(**{col: c.get(col, "") for col in SCHEDULE_COLS})
+                old = previous.get(record.key)
+                if old is not None and old.same_occurrence(record):
+                    record.registered = old.registered
+                    record.registrationId = old.registrationId
+                self.add(record)
+            for record in previous.values():
+                if (
+                    record.dateRequest,
+                    record.branchId,
+                ) in keep_days and record.key not in self.records:
+                    self.add(record)
+
+    def drop_before(self, date: datetime.date):
+        with self.transaction():
+            for record in [r for r in self.records.values() if r.as_date < date]:
+                self.remove(record.key)
+
+    def frame(self, records=None) -> pd.DataFrame:
+        if records is None:
+            records = self.records.values()
+        return pd.DataFrame([r.values() for r in records], columns=RELEVANT_COLS)
+
+    def frames_by_date(self, start: datetime.date, end: datetime.date) -> dict:
+        """
+        {dateRequest: DataFrame} of the classes between start and end, for the sheets writer
+        """
+        by_date = dict()
+        for record in self.records.values():
+            if start <= record.as_date <= end:
+                by_date.setdefault(record.dateRequest, []).append(record)
+        return {date: self.frame(records) for date, records in sorted(by_date.items())}
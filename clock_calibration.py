@@ -0,0 +1,86 @@
+import datetime
+import email.utils
+import math
+import time
+from collections import deque
+
+
+class ClockCalibrator:
+    """
+    Estimates the offset between the Fizikal server clock and the local clock
+    (server minus local, in seconds) from the Date headers of API responses.
+
+    Date only has one second resolution, so a single exchange bounds the
+    offset to an interval: the server stamped a time in [date, date + 1)
+    somewhere between sending the request and receiving the response.
+    Intersecting the intervals of several exchanges narrows the estimate,
+    and half the width of the intersection is its uncertainty.
+    The offset is only applied once the uncertainty is below max_uncertainty;
+    until then the midpoint can be up to half a second off, worse than
+    trusting the local clock.
+    """
+
+    def __init__(
+        self,
+        max_samples: int = 64,
+        max_age: float = 6 * 60 * 60,
+        max_uncertainty: float = 0.1,
+    ):
+        self.samples = deque(maxlen=max_samples)  # (lower, upper, received_at)
+        self.max_age = max_age
+        self.max_uncertainty = max_uncertainty
+
+    def add_sample(self, sent_at: float, received_at: float, date_header: str):
+        """
+        sent_at and received_at are local epoch seconds around the exchange
+        """
+        if not date_header:
+            return
+        try:
+            server_time = email.utils.parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return
+        lower = server_time - received_at
+        upper = server_time + 1 - sent_at
+        self.samples.append((lower, upper, received_at))
+
+    def restore(self, samples: list):
+        """
+        Adds checkpointed (lower, upper, received_at) samples that are still
+        recent enough to count, oldest first
+        """
+        now = time.time()
+        for lower, upper, received_at in sorted(samples, key=lambda s: s[2]):
+            if now - received_at <= self.max_age:
+                self.samples.append((lower, upper, received_at))
+
+    def estimate(self) -> tuple:
+        """
+        Returns (offset, uncertainty) in seconds.
+        Without samples the offset is 0 and the uncertainty infinite.
+        """
+        now = time.time()
+        lower, upper = -math.inf, math.inf
+        # newest first, stop before a sample contradicts the newer ones
+        # (clock step or an outlier)
+        # (a copy, the registration worker thread may be adding samples)
+        for sample_lower, sample_upper, received_at in reversed(list(self.samples)):
+            if now - received_at > self.max_age:
+                break
+            if max(lower, sample_lower) > min(upper, sample_upper):
+                break
+            lower, upper = max(lower, sample_lower), min(upper, sample_upper)
+        if math.isinf(lower) or math.isinf(upper):
+            return 0.0, math.inf
+        return (lower + upper) / 2, (upper - lower) / 2
+
+    @property
+    def offset(self) -> float:
+        """
+        The estimated offset if it is known within max_uncertainty, otherwise 0
+        """
+        offset, uncertainty = self.estimate()
+        return offset if uncertainty <= self.max_uncertainty else 0.0
+
+    def server_now(self) -> datetime.datetime:
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.offset)
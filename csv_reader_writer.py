@@ -0,0 +1,76 @@
+import logging
+import os
+import pandas as pd
+from google_sheets_reader_writer import cell_text, row_key
+
+
+class CsvReaderWriter:
+    """
+    A local CSV file standing in for the spreadsheet when use_gsheet is off,
+    behind the interface SheetSnapshotCache, SheetWriteQueue and the manager
+    use. All dates are kept in one file, the dateRequest column taking the
+    place of the date sheets. Values are read back as text, like the sheets.
+    """
+
+    def __init__(self, csv_name: str, columns: list):
+        self.csv_name = csv_name
+        self.columns = columns
+        if not os.path.exists(csv_name):
+            self.save(pd.DataFrame(columns=columns))
+
+    def load(self) -> pd.DataFrame:
+        return pd.read_csv(self.csv_name, dtype=str, keep_default_na=False)
+
+    def save(self, df: pd.DataFrame):
+        # replaced in one step so a reader never sees a half written file
+        tmp_name = self.csv_name + ".tmp"
+        df.to_csv(tmp_name, index=False)
+        os.replace(tmp_name, self.csv_name)
+
+    def revision(self) -> str:
+        return str(os.stat(self.csv_name).st_mtime_ns)
+
+    def read_cells(self, columns=None) -> pd.DataFrame:
+        df = self.load()
+        if columns is None:
+            return df
+        return df.reindex(columns=columns, fill_value="")
+
+    def write_sheets(self, frames: dict):
+        """
+        Replaces the file with {dateRequest: DataFrame}
+        """
+        frames = [df for df in frames.values() if not df.empty]
+        df = pd.concat(frames) if frames else pd.DataFrame(columns=self.columns)
+        self.save(df.map(cell_text))
+
+    def update_rows(self, rows: list):
+        """
+        Writes [(dateRequest, one-row DataFrame)] over the rows of the same
+        class; rows that aren't in the file are logged and skipped
+        """
+        df = self.load()
+        branches = df["branchId"] if "branchId" in df else [""] * len(df)
+        index = {
+            (date, (class_id, branch)): i
+            for i, (date, class_id, branch) in enumerate(
+                zip(df["dateRequest"], df["id"], branches)
+            )
+        }
+        for sheet_name, row in rows:
+            key = (sheet_name, row_key(row))
+            if key not in index:
+                logging.log(
+                    logging.ERROR,
+                    f"Dropped the update of class {key[1][0]}: not found in {self.csv_name}",
+                )
+                continue
+            values = row.iloc[0].map(cell_text)
+            df.loc[index[key], values.index] = values.values
+        self.save(df)
+
+    def delete_worksheet(self, sheet_name: str):
+        df = self.load()
+        kept = df[df["dateRequest"] != sheet_name]
+        if len(kept) < len(df):
+            self.save(kept)
@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+
+
+class DeadlineScheduler:
+    """
+    Priority queue of timed actions keyed by due time (local wall clock).
+    The run loop sleeps until the earliest action is due, or until an
+    earlier one is scheduled, and starts each due action as its own task.
+
+    Every action has a key; scheduling a key that is already queued
+    reschedules it. Rescheduling is a heap push and cancelling only marks
+    the entry, so both are O(log n); stale entries are dropped when they
+    reach the top of the heap.
+    An action returning a datetime is rescheduled at that time.
+    """
+
+    def __init__(self):
+        self.heap = []  # [due, seq, key, action, args, cancelled]
+        self.entries = dict()  # key -> live heap entry
+        self.running = dict()  # key -> task of a started action
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self) -> list:
+        return list(self.entries)
+
+    def due(self, key) -> datetime.datetime:
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def schedule(self, key, due: datetime.datetime, action, *args):
+        """
+        Runs action(*args) at due, replacing what was scheduled under key
+        """
+        self.cancel(key)
+        entry = [due, next(self.counter), key, action, args, False]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def every(self, key, interval: float, action, *args, first: datetime.datetime = None):
+        """
+        Runs action(*args) at first (default now) and then interval seconds
+        after each run finished
+        """
+
+        async def repeat():
+            try:
+                await action(*args)
+            except Exception as e:
+                logging.log(logging.ERROR, f"Scheduled action {key} failed. Error: {e}")
+            return datetime.datetime.now() + datetime.timedelta(seconds=interval)
+
+        self.schedule(key, first or datetime.datetime.now(), repeat)
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[5] = True
+
+    def pop_due(self, now: datetime.datetime) -> list:
+        due = []
+        while self.heap and (self.heap[0][5] or self.heap[0][0] <= now):
+            entry = heapq.heappop(self.heap)
+            if not entry[5]:
+                del self.entries[entry[2]]
+                due.append(entry)
+        return due
+
+    async def run(self):
+        while True:
+            for _, _, key, action, args, _ in self.pop_due(datetime.datetime.now()):
+                self.running[key] = asyncio.create_task(self.execute(key, action, args))
+            self.wakeup.clear()
+            timeout = None
+            if self.heap:
+                timeout = max(0, (self.heap[0][0] - datetime.datetime.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def execute(self, key, action, args):
+        try:
+            next_due = await action(*args)
+        except Exception as e:
+            logging.log(logging.ERROR, f"Scheduled action {key} failed. Error: {e}")
+            next_due = None
+        finally:
+            self.running.pop(key, None)
+        # unless it was rescheduled from outside meanwhile
+        if isinstance(next_due, datetime.datetime) and key not in self.entries:
+            self.schedule(key, next_due, action, *args)
+
+
+class ScopedScheduler:
+    """
+    View of a DeadlineScheduler that keeps its keys under (scope, key), so
+    several owners can share one heap and one run loop without their keys
+    colliding. Actions due at the same time are started together whatever
+    their scope.
+    """
+
+    def __init__(self, scheduler: DeadlineScheduler, scope):
+        self.scheduler = scheduler
+        self.scope = scope
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return (self.scope, key) in self.scheduler
+
+    def keys(self) -> list:
+        return [
+            key[1]
+            for key in self.scheduler.keys()
+            if isinstance(key, tuple) and len(key) == 2 and key[0] == self.scope
+        ]
+
+    def due(self, key) -> datetime.datetime:
+        return self.scheduler.due((self.scope, key))
+
+    def schedule(self, key, due: datetime.datetime, action, *args):
+        self.scheduler.schedule((self.scope, key), due, action, *args)
+
+    def every(self, key, interval: float, action, *args, first: datetime.datetime = None):
+        self.scheduler.every((self.scope, key), interval, action, *args, first=first)
+
+    def cancel(self, key):
+        self.scheduler.cancel((self.scope, key))
@@ -1,36 +1,140 @@
 from typing import Any
+from collections.abc import MutableMapping
+import copy
 import requests
-import shelve
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+import os
 import sys
+import threading
 import utils
 import json
 import datetime
+import time
+from clock_calibration import ClockCalibrator
+from state_store import StateStore
+from http_recording import HttpRecorder, HttpReplay, ReplayAdapter
+from traffic_log import TrafficLog
+import metrics
+
+# the account and app identity every request needs
+REQUIRED_KEYS = [
+    "api_base_url",
+    "phone_number",
+    "OrganizationId",
+    "companyId",
+    "branchId",
+    "sourceId",
+    "authenticationTypeId",
+]
+
+
+class BranchCache(MutableMapping):
+    """
+    Token cache of another branch of the account: access tokens are issued
+    per branch, everything else (refresh token, device id) is the account's
+    """
+
+    BRANCH_KEYS = ("access_token",)
+
+    def __init__(self, cache, branch_id: int):
+        self.cache = cache
+        self.branch_id = branch_id
+
+    def key(self, key: str) -> str:
+        if key in self.BRANCH_KEYS:
+            return f"{key}_branch_{self.branch_id}"
+        return key
+
+    def __getitem__(self, key):
+        return self.cache[self.key(key)]
+
+    def __setitem__(self, key, value):
+        self.cache[self.key(key)] = value
+
+    def __delitem__(self, key):
+        del self.cache[self.key(key)]
+
+    def __iter__(self):
+        return iter(self.cache)
+
+    def __len__(self):
+        return len(self.cache)
 
 
 class FizikalAPI:
-    def __init__(self, fizikal_config={}, persistent_storage="", mock=False):
+    def __init__(
+        self,
+        fizikal_config={},
+        persistent_storage="",
+        mock=False,
+        session: requests.Session = None,
+        clock: ClockCalibrator = None,
+        store: StateStore = None,
+    ):
+        """
+        session and clock can be shared between the APIs of several accounts
+        talking to the same host; the account that created them closes them.
+        The token cache lives in store, by default the state.db of
+        persistent_storage.
+        """
         self.base_url = fizikal_config.get("api_base_url", "")
 
         self.phone_number = fizikal_config.get("phone_number", "")
         if not self.base_url:
             raise Exception("FizikalAPI: Base URL not specified")
-        elif not self.base_url.startswith("https://"):
+        elif not self.base_url.startswith("https://") and not self.is_local(self.base_url):
             raise Exception("FizikalAPI: Base URL must be HTTPS")
         elif not self.phone_number:
             raise Exception("FizikalAPI: Phone number not specified")
         elif not persistent_storage:
             raise Exception("FizikalAPI: Persistent storage not specified")
 
-        for key in fizikal_config:
-            if not fizikal_config[key]:
+        # the tuning keys may legitimately be 0 or false
+        for key in REQUIRED_KEYS:
+            if not fizikal_config.get(key):
                 raise Exception(f"FizikalAPI: {key} not specified in config")
 
         self.mock = mock
         self.config = fizikal_config
         self.persistent_storage = persistent_storage
-        self.http_log = open(persistent_storage + "/http_requests.log", "a")
+        self.http_log = TrafficLog(
+            persistent_storage + "/http_requests.log",
+            max_bytes=int(fizikal_config.get("http_log_max_mb", 10) * 1024 * 1024),
+            max_age=fizikal_config.get("http_log_max_age_hours", 24) * 60 * 60,
+            backup_count=fizikal_config.get("http_log_backups", 10),
+            verbosity=fizikal_config.get("http_log_verbosity", {}),
+        )
+        # structured recording / replay of the exchanges, see http_recording
+        self.recorder = None
+        if fizikal_config.get("record_http"):
+            self.recorder = HttpRecorder(fizikal_config["record_http"])
+        self.replay = None
+        if fizikal_config.get("replay_http"):
+            self.replay = HttpReplay(
+                fizikal_config["replay_http"],
+                reproduce_timing=fizikal_config.get("replay_timing", False),
+            )
+        self.owns_session = session is None
+        self.session = self.create_session() if session is None else session
+        self.clock = (
+            ClockCalibrator(
+                max_uncertainty=fizikal_config.get("max_clock_uncertainty_ms", 100) / 1000
+            )
+            if clock is None
+            else clock
+        )
+        # held by whichever TokenManager (manager loop or registration worker) renews the token
+        self.renew_lock = threading.Lock()
 
-        self.cache = shelve.open(persistent_storage + "/fizikal_api_cache_" + datetime.datetime.now().strftime("%m/%d/%Y").replace('/','_'))
+        if store is None:
+            store = StateStore(os.path.join(persistent_storage, "state.db"))
+        self.cache = store.cache("fizikal_api")
+        if not "refresh_token" in self.cache:
+            # tokens of the daily shelve files from before the state store
+            store.import_shelve(
+                "fizikal_api", os.path.join(persistent_storage, "fizikal_api_cache_*")
+            )
         if not "refresh_token" in self.cache:  # First time running
             # Check if running interactive or not
             if sys.stdin.isatty():
@@ -43,6 +147,68 @@ class FizikalAPI:
                     "FizikalAPI: No refresh token found. and not running interactive."
                 )
 
+    def for_branch(self, branch_id: int) -> "FizikalAPI":
+        """
+        The API as seen from another branch the account has access to:
+        requests carry that branchId and use that branch's access token.
+        Connections, clock, logs and the refresh token are shared.
+        """
+        api = copy.copy(self)
+        api.config = dict(self.config, branchId=branch_id)
+        api.cache = BranchCache(self.cache, branch_id)
+        api.owns_session = False
+        return api
+
+    @staticmethod
+    def is_local(url: str) -> bool:
+        """
+        Plain HTTP is only allowed against a local stand-in server
+        """
+        return urlparse(url).hostname in ("localhost", "127.0.0.1")
+
+    def create_session(self) -> requests.Session:
+        """
+        One pooled keep-alive session per API instance, so consecutive calls
+        reuse the DNS lookup, TCP and TLS handshakes to the API host.
+        """
+        pool_size = int(self.config.get("http_pool_size", 10))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        if self.replay is not None:
+            adapter = ReplayAdapter(self.replay)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["connection"] = "keep-alive"
+        return session
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+        self.http_log.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def host(self) -> str:
+        return self.base_url.strip("https://").strip("http://").strip("/")
+
+    def app_headers(self) -> dict:
+        """
+        Headers the Fizikal app sends on every device-bound request
+        """
+        return {
+            "user-agent": "Dart/2.19 (dart:io)",
+            "deviceid": self.cache["device_id"],
+            "version": "70.0.5298",
+            "accept-encoding": "gzip",
+            "host": self.host(),
+        }
+
+    def ping_request(self) -> dict:
+        """
+        Cheapest exchange with the API host, used to sample its Date header
+        """
+        return dict(endpoint="/", method="HEAD")
+
     def get_mock_response(self, endpoint: str) -> requests.Response:
         normalized_endpoint = endpoint.replace("/", "_")
         with open(f"mocks/{normalized_endpoint}.json", "r") as file:
@@ -92,13 +258,7 @@ class FizikalAPI:
         if not "device_id" in self.cache:
             self.cache["device_id"] = utils.generate_device_id()
 
-        headers = {
-            "user-agent": "Dart/2.19 (dart:io)",
-            "deviceid": self.cache["device_id"],
-            "version": "70.0.5298",
-            "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
-        }
+        headers = self.app_headers()
         response = self.send_request(endpoint, "GET", params=params, headers=headers)
         if response.status_code != 200:
             raise Exception(
@@ -148,13 +308,7 @@ class FizikalAPI:
             "value": self.phone_number,
             "verificationCode": verification_code,
         }
-        headers = {
-            "user-agent": "Dart/2.19 (dart:io)",
-            "deviceid": self.cache["device_id"],
-            "version": "70.0.5298",
-            "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
-        }
+        headers = self.app_headers()
         response = self.send_request(endpoint, "GET", params=params, headers=headers)
         if response.status_code != 200:
             raise Exception(
@@ -221,12 +375,16 @@ class FizikalAPI:
         """
         if not "refresh_token" in self.cache:
             self.login()
+        response = self.send_request(**self.renew_access_token_request())
+        self.parse_renew_access_token_response(response)
+
+    def renew_access_token_request(self) -> dict:
         endpoint = "/app/v1/login/Token"
         headers = {
             "user-agent": "Dart/2.19 (dart:io)",
             "content-type": "application/x-www-form-urlencoded; charset=utf-8",
             "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
+            "host": self.host(),
         }
         data = {
             "companyId": self.config["companyId"],
@@ -234,7 +392,9 @@ class FizikalAPI:
             "organizationId": self.config["OrganizationId"],
             "refreshToken": self.cache["refresh_token"],
         }
-        response = self.send_request(endpoint, "POST", headers=headers, data=data)
+        return dict(endpoint=endpoint, method="POST", headers=headers, data=data)
+
+    def parse_renew_access_token_response(self, response):
         if response.status_code != 200:
             raise Exception(
                 f"FizikalAPI: Renew access token failed with status code {response.status_code}. Message: {response.text}"
@@ -250,6 +410,7 @@ class FizikalAPI:
                     self.cache["access_token"] = response_json.get("data", {}).get(
                         "accessToken"
                     )
+                    metrics.registry.inc("fizikal_token_renewals_total")
                 except Exception as e:
                     raise Exception(
                         f"FizikalAPI: Renew access token failed with status code {response.status_code}. Message: {response.text}"
@@ -298,14 +459,8 @@ class FizikalAPI:
         {"success":true,"statusCode":200,"data":{"class":{"id":2437,"contractId":0,"purchaseId":0,"day":"שישי","date":"01/12","dateRequest":"2023-12-01","startTime":"07:45","endTime":"08:30","replaceTime":"07:45","description":"Functional Training","instructorId":328,"instructorName":"חן מתיאס","maxParticipants":16,"totalParticipants":9,"groupsIds":[0,2],"dayPartId":1,"isFavorite":false,"locationName":"אולם ייעודי","customerStatusId":1,"action":{"text":"הרשמה","name":"AddRegistration"}},"actionStatus":1}}
         """
         endpoint = "/app/v1/classes/registration/remove"
-        headers = {
-            "user-agent": "Dart/2.19 (dart:io)",
-            "deviceid": self.cache["device_id"],
-            "version": "70.0.5298",
-            "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
-            "content-type": "application/json; charset=utf-8",
-        }
+        headers = self.app_headers()
+        headers["content-type"] = "application/json; charset=utf-8"
         data = {"id": class_id}
         response = self.send_authenticated_request(
             endpoint, "POST", headers=headers, data=json.dumps(data)
@@ -341,6 +496,12 @@ class FizikalAPI:
 
         {"success":true,"statusCode":200,"data":{"class":{"id":2516,"contractId":0,"purchaseId":0,"day":"שישי","date":"01/12","dateRequest":"2023-12-01","startTime":"10:00","endTime":"10:45","replaceTime":"10:00","description":"Spin","instructorId":377,"instructorName":"הדס סלוק","maxParticipants":20,"totalParticipants":12,"groupsIds":[0,5,15],"dayPartId":1,"isFavorite":false,"locationName":"ספינינג","registrationId":791266385,"customerStatusId":2,"action":{"text":"ביטול","name":"RemoveRegistration"}},"actionStatus":1}}
         """
+        response = self.send_authenticated_request(
+            **self.register_class_request(class_id, class_date)
+        )
+        return self.parse_class_response(response, "Register class")
+
+    def register_class_request(self, class_id: int, class_date: str) -> dict:
         endpoint = "/app/v1/classes/registration/add"
         params = {
             "contractId": 0,
@@ -348,19 +509,17 @@ class FizikalAPI:
             "classId": class_id,
             "classDate": class_date,
         }
-        headers = {
-            "user-agent": "Dart/2.19 (dart:io)",
-            "deviceid": self.cache["device_id"],
-            "version": "70.0.5298",
-            "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
-        }
-        response = self.send_authenticated_request(
-            endpoint, "GET", params=params, headers=headers
-        )
+        headers = self.app_headers()
+        return dict(endpoint=endpoint, method="GET", params=params, headers=headers)
+
+    def parse_class_response(self, response, action: str) -> dict:
+        """
+        Validates a registration/add or registration/remove response and
+        returns the "class" entry of its data
+        """
         if response.status_code != 200:
             raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
+                f"FizikalAPI: {action} failed with status code {response.status_code}. Message: {response.text}"
             )
 
         response_json = response.json()
@@ -370,12 +529,12 @@ class FizikalAPI:
             or response_json.get("statusCode", 0) != 200
         ):
             raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
+                f"FizikalAPI: {action} failed with status code {response.status_code}. Message: {response.text}"
             )
         data = response_json.get("data", {})
         if not "class" in data:
             raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
+                f"FizikalAPI: {action} failed with status code {response.status_code}. Message: {response.text}"
             )
 
         return data["class"]
@@ -394,6 +553,12 @@ class FizikalAPI:
 
         {"id":"791260333"}
         """
+        response = self.send_authenticated_request(
+            **self.remove_class_request(registration_id)
+        )
+        return self.parse_class_response(response, "Remove class")
+
+    def remove_class_request(self, registration_id: int) -> dict:
         endpoint = "/app/v1/classes/registration/remove"
         # params = {
         #     'contractId': 0,
@@ -401,38 +566,11 @@ class FizikalAPI:
         #     'classId': class_id,
         #     'classDate': class_date
         # }
-        headers = {
-            "user-agent": "Dart/2.19 (dart:io)",
-            "deviceid": self.cache["device_id"],
-            "version": "70.0.5298",
-            "accept-encoding": "gzip",
-            "host": self.base_url.strip("https://").strip("http://").strip("/"),
-        }
+        headers = self.app_headers()
         payload = {"id": registration_id}
-        response = self.send_authenticated_request(
-            endpoint, "POST", params={}, headers=headers, data=payload
+        return dict(
+            endpoint=endpoint, method="POST", params={}, headers=headers, data=payload
         )
-        if response.status_code != 200:
-            raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
-            )
-
-        response_json = response.json()
-        if (
-            not "success" in response_json
-            or not response_json["success"] == True
-            or response_json.get("statusCode", 0) != 200
-        ):
-            raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
-            )
-        data = response_json.get("data", {})
-        if not "class" in data:
-            raise Exception(
-                f"FizikalAPI: Register class failed with status code {response.status_code}. Message: {response.text}"
-            )
-
-        return data["class"]
 
     def get_classes(self, delta=1) -> dict:
         """
@@ -502,12 +640,18 @@ class FizikalAPI:
         }
 
         """
+        response = self.send_authenticated_request(**self.get_classes_request(delta))
+        return self.parse_get_classes_response(response)
+
+    def get_classes_request(self, delta=1) -> dict:
         date = (datetime.datetime.now() + datetime.timedelta(days=delta)).strftime(
             "%Y-%m-%d %H:%M:%S.%f"
         )
         params = {"date": date}
         endpoint = "/app/v1/classes/schedule/view"
-        response = self.send_authenticated_request(endpoint, params=params)
+        return dict(endpoint=endpoint, params=params)
+
+    def parse_get_classes_response(self, response) -> list:
         response_json = response.json()
         if (
             not "success" in response_json
@@ -526,19 +670,24 @@ class FizikalAPI:
 
         return data["list"]
 
+    def access_token_expired(self, margin: float = 5) -> bool:
+        expiry = utils.jwt_expiry(self.cache["access_token"])
+        return expiry is not None and expiry - time.time() <= margin
+
     def send_authenticated_request(
         self, endpoint, method="GET", headers=None, params=None, data=None
     ):
         if self.mock:
             return self.get_mock_response(endpoint)
 
-        if not "access_token" in self.cache:
+        if not "access_token" in self.cache or self.access_token_expired():
             self.renew_access_token()
         if not headers:
             headers = {}
         headers["authorization"] = f'Bearer {self.cache["access_token"]}'
         response = self.send_request(endpoint, method, headers, params, data)
         if response.status_code == 401:
+            metrics.registry.inc("fizikal_unauthorized_total", {"endpoint": endpoint})
             self.renew_access_token()
             headers["authorization"] = f'Bearer {self.cache["access_token"]}'
             response = self.send_request(endpoint, method, headers, params, data)
@@ -550,17 +699,34 @@ class FizikalAPI:
         if self.mock:
             return self.get_mock_response(endpoint)
         url = self.base_url + endpoint
-        response = requests.request(
-            method, url, headers=headers, params=params, data=data
-        )
-
-        # Log entire request and entire response
-        self.http_log.write(f"{response.request.method} {response.request.url}\n")
-        self.http_log.write(f"{response.request.headers}\n")
-        self.http_log.write(f"{response.request.body}\n")
-        self.http_log.write(f"\n {response.status_code}\n")
-        self.http_log.write(f"{response.headers}\n")
-        self.http_log.write(f"{response.text}\n")
-        self.http_log.write(f"\n\n")
+        sent_at = time.time()
+        try:
+            response = self.session.request(
+                method, url, headers=headers, params=params, data=data
+            )
+        except Exception:
+            metrics.registry.inc("fizikal_request_errors_total", {"endpoint": endpoint})
+            raise
+        received_at = time.time()
+        self.clock.add_sample(sent_at, received_at, response.headers.get("Date"))
 
+        self.log_exchange(response, sent_at, received_at)
         return response
+
+    def log_exchange(self, response, sent_at=None, received_at=None):
+        """
+        Count and time the exchange, queue it for the traffic log and record
+        it when recording.
+        Works for both requests and httpx responses.
+        """
+        labels = {"endpoint": urlparse(str(response.request.url)).path}
+        metrics.registry.inc(
+            "fizikal_responses_total", dict(labels, status=response.status_code)
+        )
+        if sent_at is not None and received_at is not None:
+            metrics.registry.observe(
+                "fizikal_request_latency_ms", 1000 * (received_at - sent_at), labels
+            )
+        if self.recorder is not None:
+            self.recorder.record(response, sent_at, received_at)
+        self.http_log.log(response, sent_at, received_at)
@@ -0,0 +1,214 @@
+import asyncio
+import time
+import httpx
+from fizikal_api import FizikalAPI
+from token_manager import TokenManager
+from http_recording import AsyncReplayTransport
+import metrics
+
+
+class AsyncFizikalAPI:
+    """
+    Non-blocking mirror of FizikalAPI for use inside the manager's event loop.
+    Shares the token cache, request building and response validation with
+    the synchronous client it wraps; only the transport differs.
+    client can be the one of another account's AsyncFizikalAPI, to share
+    its connection pool.
+    """
+
+    def __init__(self, api: FizikalAPI, client: httpx.AsyncClient = None):
+        self.api = api
+        self.owns_client = client is None
+        self.client = client if client is not None else self.create_client()
+        self.tokens = TokenManager(
+            self, refresh_margin=api.config.get("token_refresh_margin_seconds", 60)
+        )
+        self.branches = dict()  # branch id -> AsyncFizikalAPI
+
+    def for_branch(self, branch_id: int) -> "AsyncFizikalAPI":
+        """
+        Client for another branch of the account on the same connections;
+        None (or the config's branchId) is this one
+        """
+        if branch_id is None or branch_id == self.api.config.get("branchId"):
+            return self
+        if branch_id not in self.branches:
+            self.branches[branch_id] = AsyncFizikalAPI(
+                self.api.for_branch(branch_id), client=self.client
+            )
+        return self.branches[branch_id]
+
+    def create_client(self) -> httpx.AsyncClient:
+        api = self.api
+        pool_size = int(api.config.get("http_pool_size", 10))
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                # idle connections must survive the warm-up window before an opening
+                keepalive_expiry=float(api.config.get("http_keepalive_seconds", 120)),
+            ),
+            timeout=httpx.Timeout(30.0),
+            transport=AsyncReplayTransport(api.replay) if api.replay else None,
+        )
+
+    async def aclose(self):
+        if self.owns_client:
+            await self.client.aclose()
+
+    async def renew_access_token(self):
+        if not "refresh_token" in self.api.cache:
+            self.api.login()
+        response = await self.send_request(**self.api.renew_access_token_request())
+        self.api.parse_renew_access_token_response(response)
+
+    async def register_class(
+        self, class_id: int, class_date: str, prepared: httpx.Request = None
+    ) -> dict:
+        """
+        prepared is an optional request built ahead of time by
+        prepare_register_class, so that only the send remains on the hot path
+        """
+        if prepared is None or self.api.mock:
+            response = await self.send_authenticated_request(
+                **self.api.register_class_request(class_id, class_date)
+            )
+        else:
+            response = await self.send(prepared)
+            if response.status_code == 401:
+                metrics.registry.inc(
+                    "fizikal_unauthorized_total", {"endpoint": prepared.url.path}
+                )
+                await self.tokens.refresh(
+                    stale_token=prepared.headers["authorization"][len("Bearer ") :]
+                )
+                response = await self.send_authenticated_request(
+                    **self.api.register_class_request(class_id, class_date)
+                )
+        return self.api.parse_class_response(response, "Register class")
+
+    def prepare_register_class(self, class_id: int, class_date: str) -> httpx.Request:
+        if self.api.mock:
+            return None
+        return self.build_authenticated_request(
+            **self.api.register_class_request(class_id, class_date)
+        )
+
+    async def preconnect(self):
+        """
+        Opens (or keeps alive) a pooled connection to the API host
+        """
+        await self.send_request(**self.api.ping_request())
+
+    async def remove_class(self, registration_id: int) -> dict:
+        response = await self.send_authenticated_request(
+            **self.api.remove_class_request(registration_id)
+        )
+        return self.api.parse_class_response(response, "Remove class")
+
+    async def get_classes(self, delta=1) -> list:
+        response = await self.send_authenticated_request(
+            **self.api.get_classes_request(delta)
+        )
+        return self.api.parse_get_classes_response(response)
+
+    async def get_classes_batch(self, deltas, concurrency: int = 7) -> tuple:
+        """
+        Fetches the schedule of several day offsets concurrently.
+        Returns ({delta: classes}, {delta: exception}) so one failed day
+        doesn't discard the others.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(delta):
+            async with semaphore:
+                return await self.get_classes(delta)
+
+        deltas = list(deltas)
+        results = await asyncio.gather(
+            *[fetch(delta) for delta in deltas], return_exceptions=True
+        )
+        days, failures = {}, {}
+        for delta, result in zip(deltas, results):
+            if isinstance(result, Exception):
+                failures[delta] = result
+            else:
+                days[delta] = result
+        return days, failures
+
+    async def calibrate_clock(self, probes: int = 8) -> tuple:
+        """
+        Samples the server Date header a few times, spaced so the probes land
+        at different phases of the server's second, and returns the
+        (offset, uncertainty) estimate
+        """
+        for i in range(probes):
+            if i:
+                await asyncio.sleep(1 + 1 / probes)
+            await self.send_request(**self.api.ping_request())
+        return self.api.clock.estimate()
+
+    async def send_authenticated_request(
+        self, endpoint, method="GET", headers=None, params=None, data=None
+    ):
+        if self.api.mock:
+            return self.api.get_mock_response(endpoint)
+
+        await self.tokens.ensure_fresh()
+        if not headers:
+            headers = {}
+        token = self.api.cache["access_token"]
+        headers["authorization"] = f"Bearer {token}"
+        response = await self.send_request(endpoint, method, headers, params, data)
+        if response.status_code == 401:
+            metrics.registry.inc("fizikal_unauthorized_total", {"endpoint": endpoint})
+            await self.tokens.refresh(stale_token=token)
+            headers["authorization"] = f'Bearer {self.api.cache["access_token"]}'
+            response = await self.send_request(endpoint, method, headers, params, data)
+        return response
+
+    async def send_request(
+        self, endpoint, method="GET", headers=None, params=None, data=None
+    ):
+        if self.api.mock:
+            return self.api.get_mock_response(endpoint)
+        return await self.send(
+            self.build_request(endpoint, method, headers, params, data)
+        )
+
+    def build_authenticated_request(
+        self, endpoint, method="GET", headers=None, params=None, data=None
+    ) -> httpx.Request:
+        if not headers:
+            headers = {}
+        headers["authorization"] = f'Bearer {self.api.cache["access_token"]}'
+        return self.build_request(endpoint, method, headers, params, data)
+
+    def build_request(
+        self, endpoint, method="GET", headers=None, params=None, data=None
+    ) -> httpx.Request:
+        url = self.api.base_url + endpoint
+        # httpx wants raw bodies as content and form fields as data
+        if isinstance(data, (str, bytes)):
+            return self.client.build_request(
+                method, url, headers=headers, params=params, content=data
+            )
+        return self.client.build_request(
+            method, url, headers=headers, params=params, data=data
+        )
+
+    async def send(self, request: httpx.Request):
+        sent_at = time.time()
+        try:
+            response = await self.client.send(request)
+        except Exception:
+            metrics.registry.inc(
+                "fizikal_request_errors_total", {"endpoint": request.url.path}
+            )
+            raise
+        received_at = time.time()
+        self.api.clock.add_sample(sent_at, received_at, response.headers.get("Date"))
+
+        self.api.log_exchange(response, sent_at, received_at)
+        return response
@@ -0,0 +1,295 @@
+import asyncio
+import datetime
+import json
+import logging
+import glob
+import os
+import subprocess
+import sys
+import time
+import toml
+from fizikal_manager import FizikalManager
+from fizikal_stand_in import FizikalStandIn
+from precision_timer import PrecisionTimer
+from class_store import ClassRecord, REGISTER_TOKEN
+from state_store import StateStore
+
+SCENARIOS = [
+    dict(name="1_opening_warm", openings=1),
+    dict(name="10_openings_warm", openings=10),
+    dict(name="100_openings_warm", openings=100),
+    dict(name="1_opening_cold", openings=1, warm=False),
+    dict(name="10_openings_cold", openings=10, warm=False),
+    dict(name="1_opening_expired_token", openings=1, expire_tokens=True),
+    dict(name="10_openings_expired_token", openings=10, expire_tokens=True),
+    dict(name="10_openings_worker", openings=10, worker=True),
+    dict(name="100_openings_worker", openings=100, worker=True),
+    # the timers on the estimated server clock offset instead of the local clock
+    dict(name="1_opening_server_clock", openings=1, server_clock=True),
+    dict(name="1_opening_server_clock_calibrated", openings=1, server_clock=True, calibrate=True),
+]
+FIZIKAL_CONFIG = {
+    "OrganizationId": 1,
+    "companyId": 230,
+    "branchId": 14,
+    "sourceId": 1,
+    "authenticationTypeId": 1,
+    "phone_number": "0500000000",
+    "warmup_seconds_before_opening": 2,
+}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    at = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": values[-1],
+    }
+
+
+class ConfirmationRecorder:
+    """
+    Takes the place of the sheet write queue: a registration is confirmed
+    when the manager enqueues its row
+    """
+
+    def __init__(self):
+        self.confirmed = dict()  # (class id, date) -> datetime
+
+    def enqueue(self, row, sheet_name: str):
+        now = datetime.datetime.now()
+        self.confirmed.setdefault((int(row["id"].values[0]), sheet_name), now)
+
+    def pending_rows(self) -> list:
+        return []
+
+
+class BenchmarkManager(FizikalManager):
+    """
+    FizikalManager against a local stand-in API, with the openings moved
+    to a few seconds from now and the sheet IO replaced by a recorder.
+    Unless server_clock, the timers ignore the server clock estimate.
+    """
+
+    def __init__(
+        self, config_file: str, openings: dict, warm: bool = True, server_clock: bool = False
+    ):
+        super().__init__(config_file=config_file)
+        self.benchmark_openings = openings
+        self.sheet_writes = ConfirmationRecorder()
+        for sniper in [self.sniper] + ([self.worker_sniper] if self.worker else []):
+            sniper.warm = warm
+            if not server_clock:
+                # the stand-in runs on our clock, no offset to estimate
+                sniper.timer = PrecisionTimer()
+
+    def registration_opening(self, record) -> datetime.datetime:
+        return self.benchmark_openings[record.key]
+
+
+class RegistrationBenchmark:
+    """
+    Runs the registration path of FizikalManager against FizikalStandIn and
+    reports, as percentiles in ms:
+        send: opening to each registration request being sent
+        confirmed: opening to the registration being confirmed
+        loop_lag: event loop lag while the openings are handled
+    """
+
+    def __init__(self, output_dir: str = "./persist/benchmarks", stand_in_config: dict = {}):
+        self.output_dir = output_dir
+        self.stand_in_config = stand_in_config
+        os.makedirs(output_dir, exist_ok=True)
+
+    def run(self, scenarios: list = SCENARIOS) -> dict:
+        results = {
+            "started_at": datetime.datetime.now().isoformat(),
+            "version": self.version(),
+            "stand_in": self.stand_in_config,
+            "scenarios": {},
+        }
+        for scenario in scenarios:
+            print(f"Running {scenario['name']}")
+            results["scenarios"][scenario["name"]] = self.run_scenario(**scenario)
+        path = os.path.join(
+            self.output_dir,
+            datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".json",
+        )
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {path}")
+        return results
+
+    def run_scenario(
+        self,
+        name: str,
+        openings: int = 1,
+        warm: bool = True,
+        expire_tokens: bool = False,
+        worker: bool = False,
+        server_clock: bool = False,
+        calibrate: bool = False,
+        lead_seconds: float = 4,
+    ) -> dict:
+        stand_in = FizikalStandIn(
+            dict(
+                self.stand_in_config,
+                classes=[
+                    {"id": 1000 + i, "startTime": "10:00", "endTime": "11:00", "description": f"Class {i}"}
+                    for i in range(openings)
+                ],
+            )
+        )
+        base_url = stand_in.start()
+        try:
+            manager = self.create_manager(
+                name, base_url, openings, warm, worker, server_clock
+            )
+            if not warm:
+                # token from the sync session, the async client stays unconnected
+                manager.api.renew_access_token()
+            return asyncio.run(
+                self.measure(manager, stand_in, lead_seconds, expire_tokens, calibrate)
+            )
+        finally:
+            stand_in.stop()
+
+    def create_manager(
+        self,
+        name: str,
+        base_url: str,
+        openings: int,
+        warm: bool = True,
+        worker: bool = False,
+        server_clock: bool = False,
+    ) -> BenchmarkManager:
+        storage = os.path.join(self.output_dir, "runs", name)
+        os.makedirs(storage, exist_ok=True)
+        for path in glob.glob(os.path.join(storage, "state.db*")):
+            os.remove(path)
+        store = StateStore(os.path.join(storage, "state.db"))
+        cache = store.cache("fizikal_api")
+        cache["refresh_token"] = "benchmark"
+        cache["device_id"] = "benchmark"
+        store.close()
+
+        config_file = os.path.join(storage, "config.toml")
+        with open(config_file, "w") as file:
+            toml.dump(
+                {
+                    "persistent_storage": storage,
+                    "use_gsheet": False,
+                    "fizikal": dict(
+                        FIZIKAL_CONFIG,
+                        api_base_url=base_url,
+                        **({"registration_worker": True} if worker else {}),
+                    ),
+                    "csv": {"csv_name": os.path.join(storage, "Fizikal.csv")},
+                },
+                file,
+            )
+        class_date = (datetime.date.today() + datetime.timedelta(days=2)).strftime("%Y-%m-%d")
+        keys = [(1000 + i, class_date, None) for i in range(openings)]
+        manager = BenchmarkManager(config_file, dict.fromkeys(keys), warm, server_clock)
+        logging.getLogger().setLevel(logging.WARNING)
+        for classid, classdate, _ in keys:
+            manager.classes.add(
+                ClassRecord(classid, classdate, f"Class {classid}", "10:00", "11:00", REGISTER_TOKEN)
+            )
+        return manager
+
+    async def measure(
+        self, manager, stand_in, lead_seconds, expire_tokens, calibrate=False
+    ) -> dict:
+        if calibrate:
+            await manager.calibrate_clock()
+        opening = datetime.datetime.now() + datetime.timedelta(seconds=lead_seconds)
+        for key in manager.benchmark_openings:
+            manager.benchmark_openings[key] = opening
+            stand_in.set_opening(*key[:2], opening)
+        lags = []
+        monitor = asyncio.create_task(self.monitor_loop_lag(lags))
+        if expire_tokens:
+            # after the warm-up, so the prepared requests carry a revoked token
+            delay = (opening - datetime.datetime.now()).total_seconds() - 0.5
+            asyncio.get_running_loop().call_later(delay, stand_in.expire_tokens)
+        for key in manager.benchmark_openings:
+            manager.tasks[key] = asyncio.create_task(manager.register_class(*key))
+        await asyncio.gather(*manager.tasks.values(), *manager.cancel_tasks.values())
+        monitor.cancel()
+        if manager.worker is not None:
+            manager.worker.stop()
+        await manager.async_api.aclose()
+        manager.api.close()
+
+        to_ms = lambda t: (t - opening).total_seconds() * 1000
+        confirmed = manager.sheet_writes.confirmed
+        offset, uncertainty = manager.api.clock.estimate()
+        return {
+            "openings": len(manager.benchmark_openings),
+            "clock": {
+                "offset_ms": 1000 * offset,
+                "uncertainty_ms": 1000 * uncertainty,
+                "applied_offset_ms": 1000 * manager.api.clock.offset,
+            },
+            "registered": len(confirmed),
+            "send_ms": percentiles(
+                [a["offset_ms"] + a["lateness_ms"] for a in manager.registration_attempts]
+            ),
+            "confirmed_ms": percentiles([to_ms(t) for t in confirmed.values()]),
+            "server_accepted_ms": percentiles(
+                [to_ms(accepted_at) for _, _, accepted_at, _ in stand_in.registration_log]
+            ),
+            "loop_lag_ms": percentiles(lags),
+            "attempts": list(manager.registration_attempts),
+        }
+
+    async def monitor_loop_lag(self, lags: list, interval: float = 0.005):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lags.append((time.monotonic() - started - interval) * 1000)
+
+    def version(self) -> str:
+        try:
+            return subprocess.run(
+                ["git", "describe", "--always", "--dirty"], capture_output=True, text=True
+            ).stdout.strip()
+        except Exception:
+            return ""
+
+
+def compare(old_file: str, new_file: str):
+    """
+    Prints the p50 / p99 of two result files side by side
+    """
+    with open(old_file) as file:
+        old = json.load(file)
+    with open(new_file) as file:
+        new = json.load(file)
+    print(f"{'scenario':28} {'metric':18} {'old p50':>9} {'new p50':>9} {'old p99':>9} {'new p99':>9}")
+    for name, result in new["scenarios"].items():
+        previous = old["scenarios"].get(name, {})
+        for metric in ["send_ms", "confirmed_ms", "loop_lag_ms"]:
+            a, b = previous.get(metric, {}), result[metric]
+            cells = [a.get("p50"), b.get("p50"), a.get("p99"), b.get("p99")]
+            cells = ["-" if c is None else f"{c:.2f}" for c in cells]
+            print(f"{name:28} {metric:18} " + " ".join(f"{c:>9}" for c in cells))
+
+
+if __name__ == "__main__":
+    # python3 fizikal_benchmark.py [scenario ...]
+    # python3 fizikal_benchmark.py compare <old.json> <new.json>
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        names = sys.argv[1:]
+        scenarios = [s for s in SCENARIOS if not names or s["name"] in names]
+        RegistrationBenchmark().run(scenarios)
@@ -1,5 +1,8 @@
-from flask import Flask, render_template, send_from_directory
+from flask import Flask, Response, jsonify, request, render_template, send_from_directory
+from werkzeug.serving import make_server
 from fizikal_api import FizikalAPI
+import metrics
+import threading
 import toml
 import os
 from datetime import datetime
@@ -12,6 +15,25 @@ def index():
     return send_from_directory("static", "index.html")
 
 
+@app.route("/metrics")
+def get_metrics():
+    """
+    Prometheus text format, or the snapshot as JSON with ?format=json
+    """
+    if request.args.get("format") == "json":
+        return jsonify(metrics.registry.snapshot())
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1"):
+    """
+    Serves the app (for /metrics) from a background thread of the calling process
+    """
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
 def __init_config(config_file: str = "config.toml"):
     global config
     global fizikal_config
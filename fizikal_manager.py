@@ -3,50 +3,81 @@ import os
 import toml
 import sys
 from google_sheets_reader_writer import GoogleSheetReaderWriter
+from csv_reader_writer import CsvReaderWriter
+from sheet_snapshot_cache import SheetSnapshotCache
+from sheet_write_queue import SheetWriteQueue
 from fizikal_api import FizikalAPI
+from fizikal_async_api import AsyncFizikalAPI
+from precision_timer import PrecisionTimer
+from deadline_scheduler import DeadlineScheduler
+from state_store import StateStore
+import metrics
+from fizikal_http_server import serve_metrics
+from registration_burst import SUCCESS, FULL
+from registration_worker import RegistrationSniper, RegistrationWorker
+from class_store import (
+    ClassStore,
+    REGISTER_TOKEN,
+    REMOVAL_TOKEN,
+    DEFAULT_REGISTRATION_ID,
+    RELEVANT_COLS,
+    frame_key,
+)
 import logging
 import datetime
+import time
+from collections import deque
 import pandas as pd
 import datetime
 
-FULL_CLASS = "השיעור התמלא"
-CLASS_NOT_OPEN = "הרשמה לשיעור תיפתח ביום"
-REGISTER_TOKEN = "v"
-REMOVAL_TOKEN = "x"
-DEFAULT_REGISTRATION_ID = -1
-RELEVANT_COLS = [
-    "id",
-    "dateRequest",
-    "description",
-    "startTime",
-    "endTime",
-    "registered",
-    "registrationId",
-]
 
 hours2seconds = lambda x: x * 60 * 60
 
 
-def get_second_dif(date: str, time: str, subtract_day: bool = False):
-    y, mon, d = date.split("-")
-    h, m = time.split(":")
-    target_date = datetime.datetime(
-        int(y), month=int(mon), day=int(d), hour=int(h), minute=int(m)
+def init_logging(persistent_storage: str):
+    log_dir = os.path.join(persistent_storage, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    log_file = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".log"
+    log_path = os.path.join(log_dir, log_file)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.FileHandler(log_path), logging.StreamHandler()],
     )
-    if subtract_day:
-        target_date = target_date - datetime.timedelta(days=1)
-    return (target_date - datetime.datetime.now()).total_seconds()
+    logging.log(logging.INFO, "Logging initialized")
 
 
 class FizikalManager:
-    def __init__(self, config_file: str = "config.toml", mock: bool = False):
+    def __init__(
+        self,
+        config_file: str = "config.toml",
+        mock: bool = False,
+        config: dict = None,
+        share_with: "FizikalManager" = None,
+        scheduler: DeadlineScheduler = None,
+    ):
+        """
+        config, when given, is used instead of loading config_file.
+        share_with is another manager whose HTTP connections and server
+        clock this one uses, scheduler one shared with other managers (see
+        multi_account_manager)
+        """
         self.mock_http = mock
-        self.classes = pd.DataFrame()
+        self.share_with = share_with
         self.tasks = dict()
         self.cancel_tasks = dict()
-        self.__init_config(config_file)
+        self.loaded_sheet_revision = None
+        self.registration_attempts = deque(maxlen=1000)
+        self.timer = PrecisionTimer(offset_provider=lambda: self.api.clock.offset)
+        self.scheduler = scheduler if scheduler is not None else DeadlineScheduler()
+        self.sync_lock = asyncio.Lock()
+        self.__init_config(config_file, config)
         self._init_logging()
+        self._init_store()
         self._init_api()
+        self.restore()
 
         if self.config['use_gsheet']:
             self._init_google_sheets()
@@ -54,21 +85,16 @@ class FizikalManager:
             self._init_csv()
 
     def _init_csv(self):
-        self.pd = pd.DataFrame()
-        self.pd.to_csv(self.config['csv']['csv_name'])
+        csv_config = self.config.get("csv", {})
+        # the CSV file takes the place of the spreadsheet
+        self.google_sheet_rw = CsvReaderWriter(
+            csv_config.get("csv_name", "Fizikal.csv"), RELEVANT_COLS
+        )
+        self._init_sheet_queues(csv_config)
         logging.log(logging.INFO, "CSV initialized")
 
-    def __init_config(self, config_file: str = "config.toml"):
-        if not config_file:
-            print("No config file specified")
-            exit(1)
-        elif not config_file.endswith(".toml"):
-            print("Config file must be a .toml file")
-            exit(1)
-        elif not os.path.exists(config_file):
-            print("Config file does not exist")
-            exit(1)
-        self.config = toml.load(config_file)
+    def __init_config(self, config_file: str = "config.toml", config: dict = None):
+        self.config = config if config is not None else load_config(config_file)
 
         self.persistent_storage = self.config.get("persistent_storage", "./persist")
         if not os.path.exists(self.persistent_storage):
@@ -91,43 +117,100 @@ class FizikalManager:
             self.google_sheets_config["service_account_key"],
             self.google_sheets_config["sheet_name"],
         )
+        self._init_sheet_queues(self.google_sheets_config)
         logging.log(logging.INFO, "Google Sheets initialized")
 
+    def _init_sheet_queues(self, sheet_config: dict):
+        """
+        The read snapshot and the write-behind queue in front of google_sheet_rw
+        """
+        self.sheet_snapshots = SheetSnapshotCache(
+            self.google_sheet_rw,
+            columns=RELEVANT_COLS,
+            min_check_interval=sheet_config.get("min_check_seconds", 5),
+        )
+        self.sheet_writes = SheetWriteQueue(
+            self.google_sheet_rw,
+            flush_interval=sheet_config.get("write_flush_seconds", 2),
+            max_writes_per_minute=sheet_config.get("max_writes_per_minute", 50),
+        )
+
+    def _init_store(self):
+        self.store = StateStore(os.path.join(self.persistent_storage, "state.db"))
+        # the last known schedule and registrations, before any network call
+        self.classes = ClassStore(self.store)
+        self.classes.load()
+        self.checkpoints = self.store.cache("manager")
+        logging.log(logging.INFO, f"State store loaded: {len(self.classes)} classes")
+
     def _init_api(self):
+        shared = self.share_with
         self.api = FizikalAPI(
             fizikal_config=self.fizikal_config,
             persistent_storage=self.persistent_storage,
             mock=self.mock_http,
+            store=self.store,
+            session=shared.api.session if shared else None,
+            clock=shared.api.clock if shared else None,
+        )
+        self.async_api = AsyncFizikalAPI(
+            self.api, client=shared.async_api.client if shared else None
         )
+        self.sniper = RegistrationSniper(
+            self.async_api, self.timer, self.fizikal_config, self.registration_attempts
+        )
+        self.worker = None
+        if self.fizikal_config.get("registration_worker"):
+            # one worker thread and connection pool for all the accounts
+            self.owns_worker = shared is None or shared.worker is None
+            self.worker = (
+                RegistrationWorker(
+                    self.api,
+                    # process wide while the worker runs (Python's default is 5 ms)
+                    switch_interval=self.fizikal_config.get("worker_switch_interval_ms", 1)
+                    / 1000,
+                )
+                if self.owns_worker
+                else shared.worker
+            )
+            self.worker_sniper = self.worker.sniper(
+                self.api, self.fizikal_config, self.registration_attempts
+            )
         logging.log(logging.INFO, "API initialized")
 
     def _init_logging(self):
-        log_dir = os.path.join(self.persistent_storage, "logs")
-        os.makedirs(log_dir, exist_ok=True)
+        init_logging(self.persistent_storage)
 
-        log_file = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".log"
-        log_path = os.path.join(log_dir, log_file)
-
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s [%(levelname)s] %(message)s",
-            handlers=[logging.FileHandler(log_path), logging.StreamHandler()],
+    def restore(self):
+        """
+        Warm restart: re-arms the registrations and removal deadlines of the
+        stored state and restores the checkpointed server clock samples.
+        Runs before any network call (the sheets, the schedule, the clock
+        calibration), so an opening close to a restart isn't missed.
+        """
+        started = time.monotonic()
+        self.api.clock.restore(self.checkpoints.get("clock_samples", []))
+        interrupted = self.store.tasks("registering")
+        self.schedule_registrations()
+        logging.log(
+            logging.INFO,
+            f"Restored {len(self.scheduler)} scheduled actions "
+            f"({len(interrupted)} interrupted registrations) in "
+            f"{(time.monotonic() - started) * 1000:.1f} ms",
         )
-        logging.log(logging.INFO, "Logging initialized")
 
-    async def periodic_check_gsheets_for_registration_requests(
-        self, interval: int = 60
-    ):
-        interval = self.google_sheets_config.get("polling_interval_minutes", 60)
-        while True:
-            logging.log(
-                logging.INFO, "Checking Google Sheets for registration requests"
-            )
-            self.classes = self.google_sheet_rw.read_cells()
-            await asyncio.sleep(hours2seconds(interval))
+    async def checkpoint(self):
+        """
+        Saves the state that isn't written through to the store as it
+        changes: the server clock samples, so a restart has an offset
+        estimate without calibrating first
+        """
+        self.checkpoints["clock_samples"] = list(self.api.clock.samples)
 
-    async def periodic_get_classes(self):
+    async def update_schedule(self):
         """
+            Fetches the next week's schedule, merges it into the store and writes it to the sheets.
+
             Expected output:
             [
                 {
@@ -149,326 +232,297 @@ class FizikalManager:
             ...
             ]
         """
-        interval = self.fizikal_config.get("get_classes_every_x_hours", 60)
-        while True:
-            self.update_classes_from_sheet()
-            logging.log(logging.INFO, "Updated classes from sheets")
-            logging.log(logging.INFO, "Getting classes")
-            new_classes = pd.DataFrame()
-            try:
-                for i in range(7):  # get next week's classes
-                    classes = self.api.get_classes(i)
-                    new_classes = pd.concat(
-                        [new_classes, pd.DataFrame(classes)], ignore_index=True
-                    )
-                # new_classes["registered"] = REMOVAL_TOKEN
-                # new_classes["registrationId"] = DEFAULT_REGISTRATION_ID
-                self.merge_classes(new_classes)
-                self.classes["as_date"] = self.classes.apply(
-                    lambda y: datetime.date(
-                        *[int(d) for d in y["dateRequest"].split("-")]
-                    ),
-                    axis=1,
+        await self.update_classes_from_sheet()
+        logging.log(logging.INFO, "Updated classes from sheets")
+        try:
+            self.apply_schedule(*await self.fetch_schedule())
+        except Exception as e:
+            logging.log(logging.ERROR, f"Failed to get classes. Error: {e}")
+
+    def branch_ids(self) -> list:
+        """
+        Branches whose schedules are tracked: None for the branch of the
+        config, then the other ids of the "branches" config list ("all" for
+        every branch the login response listed)
+        """
+        branches = self.fizikal_config.get("branches", [])
+        if branches == "all":
+            branches = [
+                b.get("accessToBranchId") for b in self.api.cache.get("branches") or []
+            ]
+        home = self.fizikal_config.get("branchId")
+        others = [int(b) for b in branches if b and int(b) != home]
+        return [None] + list(dict.fromkeys(others))
+
+    async def fetch_schedule(self) -> tuple:
+        """
+        Fetches next week's classes of every tracked branch concurrently.
+        Returns (classes tagged with their branchId, {(dateRequest, branchId)
+        of the days whose fetch failed})
+        """
+        logging.log(logging.INFO, "Getting classes")
+        branches = self.branch_ids()
+        results = await asyncio.gather(
+            *[
+                self.async_api.for_branch(branch_id).get_classes_batch(
+                    range(7),
+                    concurrency=self.fizikal_config.get("get_classes_concurrency", 7),
                 )
-                self.classes.loc[self.classes['registered'].isna(), 'registered'] = REMOVAL_TOKEN
-                self.classes.loc[self.classes['registrationId'].isna(), 'registrationId'] = DEFAULT_REGISTRATION_ID
-                self.write_classes_to_google_sheets()
-                self.beutify_google_sheets()
-                self.classes = self.classes.loc[
-                    self.classes.as_date >= datetime.date.today()
-                ]
-            except Exception as e:
-                logging.log(logging.ERROR, f"Failed to get classes. Error: {e}")
-
-            await asyncio.sleep(hours2seconds(interval))
-    
-    def merge_classes(self, new_classes):
-        """
-        Left merges classes
-        """
-        self.classes = pd.merge(new_classes,
-                                self.classes,
-                                how="left",
-                                on=[r for r in RELEVANT_COLS if 'regis' not in r]
-                                )
-        
-    
-    def get_class_ids_registrations_dates(self):
-        """
-        gets all classes in which we are either registered or want to register (or both, but we'll ignore this)
-        """
-        if "registered" not in self.classes.columns:
-            return [], [], []
-        relevant_classes = self.classes.loc[
-            (self.classes.registered == REGISTER_TOKEN)
-            | (self.classes.registrationId > DEFAULT_REGISTRATION_ID),
-            :,
-        ]
-        return (
-            relevant_classes.id.values,
-            relevant_classes.registrationId.values,
-            relevant_classes.dateRequest.values,
+                for branch_id in branches
+            ]
         )
+        classes, failed_days = [], set()
+        for branch_id, (days, failures) in zip(branches, results):
+            for delta in sorted(days):
+                classes.extend(dict(c, branchId=branch_id) for c in days[delta])
+            for delta, error in failures.items():
+                logging.log(
+                    logging.ERROR,
+                    f"Failed to get classes {delta} days ahead (branch {branch_id or 'of the config'}). Error: {error}",
+                )
+                date = datetime.date.today() + datetime.timedelta(days=delta)
+                failed_days.add((date.strftime("%Y-%m-%d"), branch_id))
+        if not any(days for days, _ in results):
+            raise Exception("no day of the schedule could be fetched")
+        return classes, failed_days
 
-    async def periodic_register_classes(self):
-        """
-        Expected output:
-        [
-            {
-                "id": 3100,
-                "day": "שישי",
-                "date": "01/12",
-                "startTime": "07:00",
-                "endTime": "07:45",
-                "description": "Body Shape",
-                "instructorName": "ליליה קרנדל",
-                "maxParticipants": 24,
-                "totalParticipants": 14,
-                "locationName": "אולם תנועה",
-                "action": {
-                "text": "הרשמה",
-                "name": "AddRegistration"
-                }
-            },
-        ...
-        ]
-        """
-        interval = self.fizikal_config.get("register_classes_every_x_hours", 60)
-        await self.wait_for_classes()
-        while True:
-            logging.log(logging.INFO, "Registering Classes")
-            self.update_classes_from_sheet()
-            (
-                classids,
-                registration_ids,
-                classdates,
-            ) = self.get_class_ids_registrations_dates()
-
-            for classid, classdate, reg_id in zip(
-                classids, classdates, registration_ids
-            ):
-                if self.is_class_token(classid, REMOVAL_TOKEN) or (
-                    reg_id > DEFAULT_REGISTRATION_ID
-                ) or (classid, classdate) in self.tasks:  # already registered or task exists
-                    continue
-                try:
-                    task = asyncio.create_task(self.register_class(classid, classdate))
-                    self.tasks[(classid, classdate)] = task
-                except Exception as e:
-                    logging.log(
-                        logging.ERROR, f"Failed to register to class. Error: {e}"
-                    )
-                    continue
+    def apply_schedule(self, classes: list, failed_days: set):
+        """
+        Merges a fetched schedule into the store and writes it to the sheets
+        """
+        self.merge_classes(classes, failed_days=failed_days)
+        self.write_classes_to_google_sheets()
+        self.beutify_google_sheets()
+        self.classes.drop_before(datetime.date.today())
 
-            # if len(classids) > 0:
-            #     self.write_classes_to_google_sheets()
-            await asyncio.sleep(hours2seconds(interval))
-    
-    def is_class_token(self, classid, token):
-        return (
-                    self.classes.loc[self.classes.id == classid, "registered"]
-                    == token
-                ).all()
+    def merge_classes(self, new_classes, failed_days=()):
+        """
+        Replaces the schedule with new_classes, keeping known registration
+        state. Classes of failed_days ((dateRequest, branchId) whose fetch
+        failed) are kept.
+        """
+        self.classes.merge_schedule(new_classes, keep_days=failed_days)
+
+    async def sync_registrations(self):
+        """
+        Brings the scheduled registrations in line with the sheet and removes
+        the registrations marked for removal
+        """
+        async with self.sync_lock:
+            try:
+                await self.update_classes_from_sheet()
+            except Exception as e:
+                # the store still holds the last known state
+                logging.log(logging.ERROR, f"Failed to read the sheets. Error: {e}")
+            self.schedule_registrations()
+            await self.remove_classes()
 
-    async def register_class(self, classid, classdate):
+    def schedule_registrations(self):
+        """
+        Feeds the scheduler with the warm-up of each wanted class's
+        registration opening, a clock calibration before it and, for the
+        classes we are registered to, the deadline for removing the
+        registration. Scheduled registrations no longer wanted are cancelled.
+        """
+        warmup_lead = datetime.timedelta(
+            seconds=self.fizikal_config.get("warmup_seconds_before_opening", 45)
+        )
+        calibration_lead = datetime.timedelta(
+            seconds=self.fizikal_config.get("clock_calibration_lead_seconds", 120)
+        )
+        removal_deadline = datetime.timedelta(
+            hours=self.fizikal_config.get("removal_deadline_hours", 3)
+        )
+        wanted = set()
+        # registered, but without a registration id the store can't tell
+        done = self.store.tasks(SUCCESS)
+        for record in self.classes.wanted_or_registered():
+            key = record.key
+            try:
+                if record.registrationId > DEFAULT_REGISTRATION_ID:
+                    # last look at the sheet before the registration can't be cancelled.
+                    # Only ahead of it: the deadline action syncs, which lands here again
+                    deadline = record.start - removal_deadline
+                    if (
+                        deadline > datetime.datetime.now()
+                        and ("removal_deadline", key) not in self.scheduler
+                    ):
+                        self.scheduler.schedule(
+                            ("removal_deadline", key), deadline, self.removal_deadline
+                        )
+                    continue
+                wanted.add(key)
+                if key in self.tasks or key in done or ("register", key) in self.scheduler:
+                    continue
+                opening = self.registration_opening(record)
+                self.scheduler.schedule(
+                    ("register", key), opening - warmup_lead, self.start_registration, key
+                )
+                self.store.set_task(key, "scheduled", opening)
+                self.scheduler.schedule(
+                    ("calibrate", key), opening - calibration_lead, self.calibrate_clock
+                )
+            except Exception as e:
+                logging.log(logging.ERROR, f"Failed to schedule registration. Error: {e}")
+
+        for entry in self.scheduler.keys():
+            # the periodic jobs are keyed by plain names
+            if not isinstance(entry, tuple):
+                continue
+            kind, key = entry
+            if kind == "register" and key not in wanted:
+                self.scheduler.cancel(("register", key))
+                self.scheduler.cancel(("calibrate", key))
+                self.store.delete_task(key)
+        for key in [k for k in self.tasks if k not in wanted]:
+            self.tasks.pop(key).cancel()
+            self.store.delete_task(key)
+
+    async def start_registration(self, key):
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self.register_class(*key))
+
+    async def removal_deadline(self):
+        self.sheet_snapshots.invalidate()
+        await self.sync_registrations()
+
+    def is_class_token(self, key, token):
+        record = self.classes.get(key)
+        return record is not None and record.registered == token
+
+    async def register_class(self, classid, classdate, branch_id=None):
         """
         calculates the start time of the class.
-        Starts a timer up to the start of the registration
+        Registers at its opening, on the registration worker when it runs
         """
+        key = (classid, classdate, branch_id)
         # get class starting time
-        row = self.classes.loc[
-            (self.classes.id == classid) & (self.classes.dateRequest == classdate), :
-        ]
-        classname = row.description
+        record = self.classes.get(key)
         logging.log(
-            logging.INFO, f"Created task: register to {classname} at {classdate}"
+            logging.INFO, f"Created task: register to {record.description} at {classdate}"
         )
-        time = row["startTime"].values[0]
 
-        y, mon, d = classdate.split("-")
-        h, m = time.split(":")
-        end_time = datetime.datetime(
-            int(y), month=int(mon), day=int(d), hour=int(h), minute=int(m)
+        registration_date = self.registration_opening(record)
+        self.store.set_task(key, "registering", registration_date)
+        logging.log(
+            logging.INFO, f"Registering Class\n{self.classes.frame([record])}"
         )
 
-        # # subtract since we want to register a day in advance
-        registration_date = end_time - datetime.timedelta(days=1)
-
-        delay_seconds = (
-            registration_date - datetime.datetime.now()
-        ).total_seconds() - 0.005
-        # Use asyncio.sleep to wait until the start time
-        await asyncio.sleep(max(0, delay_seconds))
+        if self.worker is not None:
+            outcome, result = await self.worker.register(
+                self.worker_sniper, classid, classdate, registration_date, branch_id
+            )
+        else:
+            outcome, result = await self.sniper.register(
+                classid, classdate, registration_date, branch_id
+            )
 
-        while registration_date > datetime.datetime.now():
-            pass
-        while (classid, classdate) in self.tasks:
-            try:
-                classloc = self.classes.loc[self.classes.id == classid, RELEVANT_COLS]
-                logging.log(logging.INFO, f"Registering Class\n{classloc}")
-                resp = self.api.register_class(classid, classdate)
-                self.classes.loc[
-                    self.classes.id == classid, "registered"
-                ] = REGISTER_TOKEN
-                self.classes.loc[self.classes.id == classid, "registrationId"] = resp[
-                    "registrationId"
-                ]
+        metrics.registry.inc("fizikal_registrations_total", {"outcome": outcome})
+        self.store.set_task(key, outcome)
+        if outcome == SUCCESS:
+            # the store may have been reloaded from the sheet meanwhile
+            record = self.classes.get(key)
+            registration_id = result.get("registrationId") or DEFAULT_REGISTRATION_ID
+            if registration_id == DEFAULT_REGISTRATION_ID:
+                # the task state 'success' keeps it from being registered again
+                logging.log(
+                    logging.WARNING,
+                    f"Registered to {classid} at {classdate} without a registration id, it can't be removed from here",
+                )
+            if record is not None:
+                self.classes.set_registration(record.key, REGISTER_TOKEN, registration_id)
                 # update with the registration id
-                self.google_sheet_rw.update_row(
-                    row=self.classes.loc[self.classes.id == classid, RELEVANT_COLS],
+                self.sheet_writes.enqueue(
+                    row=self.classes.frame([record]),
                     sheet_name=classdate,
                 )
-                logging.log(logging.INFO, f"Successfully registered to class!")
-                self.cancel_tasks[(classid, classdate)] = self.tasks[
-                    (classid, classdate)
-                ]
-                del self.tasks[(classid, classdate)]
-                break
-            except Exception as e:  # Failed to registrate
-                if FULL_CLASS in e.args[0]:
-                    logging.log(
-                        logging.ERROR, f"Failed to register class. Class is full"
-                    )
-                    break
-                elif CLASS_NOT_OPEN in e.args[0]:
-                    # logging.log(logging.ERROR, f"Failed to register class. Class is still not open")
-                    await asyncio.sleep(0.5)
+            logging.log(logging.INFO, f"Successfully registered to class!")
+            if key in self.tasks:
+                self.cancel_tasks[key] = self.tasks.pop(key)
+        elif outcome == FULL:
+            logging.log(logging.ERROR, f"Failed to register class. Class is full")
+        else:
+            logging.log(logging.ERROR, f"Failed to register class. Error: {result}")
 
-    async def wait_for_classes(self):
-        while self.classes.empty:
-            await asyncio.sleep(20)
+    def registration_opening(self, record) -> datetime.datetime:
+        """
+        Registration opens a day before the class starts
+        """
+        return record.start - datetime.timedelta(days=1)
 
-    async def periodic_remove_classes(self):
+    async def calibrate_clock(self):
+        """
+        Re-estimates the server clock offset; scheduled hourly and shortly
+        before each registration opening
+        """
+        if self.mock_http:
+            return
+        try:
+            offset, uncertainty = await self.async_api.calibrate_clock()
+            logging.log(
+                logging.INFO,
+                f"Server clock offset {offset * 1000:.1f} ms (+/- {uncertainty * 1000:.1f} ms)",
+            )
+        except Exception as e:
+            logging.log(logging.ERROR, f"Failed to calibrate server clock. Error: {e}")
 
-        await self.wait_for_classes()
-        while True:
-            logging.log(logging.INFO, "Removing Classes")
-            """
-            Expected output:
-            [
-                {
-                    "id": 3100,
-                    "day": "שישי",
-                    "date": "01/12",
-                    "startTime": "07:00",
-                    "endTime": "07:45",
-                    "description": "Body Shape",
-                    "instructorName": "ליליה קרנדל",
-                    "maxParticipants": 24,
-                    "totalParticipants": 14,
-                    "locationName": "אולם תנועה",
-                    "action": {
-                    "text": "הרשמה",
-                    "name": "AddRegistration"
-                    }
-                },
-            ...
-            ]
-            """
-            self.update_classes_from_sheet()
-            (
-                classids,
-                registration_ids,
-                rel_dates,
-            ) = self.get_class_ids_registrations_dates()
-
-            for classid, reg_id, classdate in zip(
-                classids, registration_ids, rel_dates
-            ):
-                # marked as 'dont register' but has a registration id
-                clause = self.is_class_token(classid, REMOVAL_TOKEN) and (reg_id > DEFAULT_REGISTRATION_ID)
-                if clause:
-                    try:
-                        resp = self.api.remove_class(reg_id)
-                        classname = self.classes.loc[
-                            self.classes.registrationId == reg_id
-                        ].description
-                        self.classes.loc[
-                            self.classes.id == classid, "registered"
-                        ] = REMOVAL_TOKEN
-                        self.classes.loc[
-                            self.classes.id == classid, "registrationId"
-                        ] = DEFAULT_REGISTRATION_ID
-                        logging.log(
-                            logging.INFO, f"Successfully removed class {classname}"
-                        )
-                    except Exception as e:
-                        logging.log(
-                            logging.ERROR, f"Failed to remove class. Error: {e}"
-                        )
-                        continue
-                    self.google_sheet_rw.update_row(
-                        row=self.classes.loc[self.classes.id == classid, RELEVANT_COLS],
-                        sheet_name=classdate,
-                    )
-                if ((classid, classdate) in self.tasks) and self.is_class_token(classid, REMOVAL_TOKEN):
-                    self.tasks[(classid, classdate)].cancel()
-                    del self.tasks[(classid, classdate)]
-            
-            sleeptime = self.get_class_removal_sleeptime()
-            
-            await asyncio.sleep(sleeptime)
-
-    def get_class_removal_sleeptime(self):
-        interval = self.fizikal_config.get("remove_classes_every_x_hours", 60)
-        sleeptime = hours2seconds(interval)
-        next_upcoming_class = self.classes.loc[
-            self.classes.registrationId > DEFAULT_REGISTRATION_ID
-        ]
-        next_upcoming_registration = self.classes.loc[
-            (self.classes.registrationId == DEFAULT_REGISTRATION_ID)
-            & (self.classes.registered == REGISTER_TOKEN)
-        ]
-        buffer_time_before_upcoming_class = -1
-        if (
-            not next_upcoming_class.empty
-        ):  # sleep the minimum between the defined interval and 1 hour 3 hours before the next upcoming class
-            next_upcoming_class = next_upcoming_class.iloc[0]
-            class_date = next_upcoming_class.dateRequest
-            class_time = next_upcoming_class.startTime
-            buffer_time_before_upcoming_class = get_second_dif(
-                class_date, class_time
-            ) - hours2seconds(3)
-        elif (
-            not next_upcoming_registration.empty
-        ):  # sleeping up until 5 seconds before next registration time
-            next_upcoming_registration = next_upcoming_registration.iloc[0]
-            class_date = next_upcoming_registration.dateRequest
-            class_time = next_upcoming_registration.startTime
-            buffer_time_before_upcoming_class = (
-                get_second_dif(class_date, class_time, subtract_day=True) - 5 * 60
-            )  # minus 5 minutes
-
-        if buffer_time_before_upcoming_class < 0:
-            pass
-        else:
-            sleeptime = min(buffer_time_before_upcoming_class, sleeptime)
+    async def refresh_token(self) -> datetime.datetime:
+        """
+        Refreshes the access token ahead of its expiry and returns when to look again
+        """
+        sleeptime = await self.async_api.tokens.refresh_due()
+        return datetime.datetime.now() + datetime.timedelta(seconds=sleeptime)
 
-        return sleeptime
+    async def remove_classes(self):
+        """
+        Removes the registrations of classes marked as 'dont register'
+        """
+        for record in self.classes.registered():
+            key = record.key
+            if not self.is_class_token(key, REMOVAL_TOKEN):
+                continue
+            try:
+                await self.async_api.for_branch(record.branchId).remove_class(
+                    record.registrationId
+                )
+                self.classes.set_registration(
+                    key, REMOVAL_TOKEN, DEFAULT_REGISTRATION_ID
+                )
+                logging.log(
+                    logging.INFO, f"Successfully removed class {record.description}"
+                )
+            except Exception as e:
+                logging.log(logging.ERROR, f"Failed to remove class. Error: {e}")
+                continue
+            self.scheduler.cancel(("removal_deadline", key))
+            # so the class can be registered again
+            self.store.delete_task(key)
+            self.sheet_writes.enqueue(
+                row=self.classes.frame([record]),
+                sheet_name=record.dateRequest,
+            )
 
-    def update_classes_from_sheet(self):
-        sheet_content = self.google_sheet_rw.read_cells()
+    async def update_classes_from_sheet(self):
+        revision, sheet_content = await self.sheet_snapshots.read()
+        # the store already holds this revision plus our own changes since
+        if revision == self.loaded_sheet_revision:
+            return
+        self.loaded_sheet_revision = revision
         if len(sheet_content) > 0:
-            self.classes = sheet_content
-        if False:
-            self.classes["as_date"] = self.classes.apply(
-                        lambda y: datetime.date(
-                            *[int(d) for d in y["dateRequest"].split("-")]
-                        ),
-                        axis=1,
+            self.classes.apply_sheet(sheet_content)
+            # updates still waiting in the write-behind queue are newer than the sheet
+            for row in self.sheet_writes.pending_rows():
+                key = frame_key(row)
+                if key in self.classes:
+                    self.classes.set_registration(
+                        key, row["registered"].values[0], row["registrationId"].values[0]
                     )
-        else:
-            print("I skipped something here. maybe put it again")
 
-    def write_classes_to_google_sheets(self, classes=None):
-        if classes is None:
-            classes = self.classes
+    def write_classes_to_google_sheets(self):
         today = datetime.date.today()
         # write only dates in the next week
-        classes = classes.loc[classes.as_date >= today]
-        classes = classes.loc[classes.as_date <= (today + datetime.timedelta(days=7))]
-        for date, datedf in classes.groupby("dateRequest"):
-            self.google_sheet_rw.write_cells(datedf[RELEVANT_COLS], date)
+        frames = self.classes.frames_by_date(today, today + datetime.timedelta(days=7))
+        self.google_sheet_rw.write_sheets(frames)
 
     def beutify_google_sheets(self):
         for i in range(1, 7):
@@ -480,45 +534,86 @@ class FizikalManager:
             except:
                 pass
 
-    async def periodic_remove_tasks(self):
-        while True:
-            tasks_to_dlt = list(self.cancel_tasks.keys())
-            for k in tasks_to_dlt:
-                self.cancel_tasks[k].cancel()
-                del self.cancel_tasks[k]
-            await asyncio.sleep(hours2seconds(0.5))  # sleep half an hour
+    async def cleanup(self):
+        tasks_to_dlt = list(self.cancel_tasks.keys())
+        for k in tasks_to_dlt:
+            self.cancel_tasks[k].cancel()
+            del self.cancel_tasks[k]
+        self.store.prune_tasks(datetime.datetime.now() - datetime.timedelta(days=1))
+
+    def schedule_jobs(self):
+        """
+        Schedules the periodic jobs that only concern this manager's account
+        """
+        self.scheduler.every(
+            "sync_registrations",
+            60 * self.google_sheets_config.get("polling_interval_minutes", 1),
+            self.sync_registrations,
+        )
+        self.scheduler.every("cleanup", hours2seconds(0.5), self.cleanup)
+        self.scheduler.every(
+            "checkpoint",
+            self.fizikal_config.get("checkpoint_seconds", 60),
+            self.checkpoint,
+        )
+        if not self.mock_http:
+            self.scheduler.schedule(
+                "refresh_token", datetime.datetime.now(), self.refresh_token
+            )
+
+    async def close(self):
+        await self.checkpoint()
+        await self.sheet_writes.close()
+        if self.worker is not None and self.owns_worker:
+            self.worker.stop()
 
     def start(self):
         self.loop = asyncio.get_event_loop()
-        logging.log(logging.INFO, "Starting periodic tasks")
-        self.loop.create_task(self.periodic_get_classes())
-        self.loop.create_task(self.periodic_register_classes())
-        self.loop.create_task(self.periodic_remove_classes())
-        self.loop.create_task(self.periodic_remove_tasks())
-        self.loop.run_forever()
-        self.loop.close()
+        logging.log(logging.INFO, "Starting scheduler")
+        self.scheduler.every(
+            "update_schedule",
+            hours2seconds(self.fizikal_config.get("get_classes_every_x_hours", 60)),
+            self.update_schedule,
+        )
+        self.scheduler.every("calibrate_clock", hours2seconds(1), self.calibrate_clock)
+        self.schedule_jobs()
+        self.loop.create_task(self.scheduler.run())
+        self.loop.create_task(self.sheet_writes.run())
+        if self.config.get("metrics_port"):
+            serve_metrics(self.config["metrics_port"])
+            logging.log(logging.INFO, f"Serving /metrics on port {self.config['metrics_port']}")
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.close())
+            self.loop.close()
 
     def start_as_flask_server(self):
         pass
 
-def restart_cache():
-    exists = False
-    name = ''
-    for file in os.listdir('persist'):
-        if 'fizikal_api' in file:
-            name = file
-            exists = True
-    if exists:
-        date = '/'.join(name.split('_')[-3:])
-        if  (datetime.datetime.now() - datetime.datetime.strptime(date, "%m/%d/%Y")).days > 0:
-            os.system(f"rm -f persist/{name}")
 
+def load_config(config_file: str = "config.toml") -> dict:
+    if not config_file:
+        print("No config file specified")
+        exit(1)
+    elif not config_file.endswith(".toml"):
+        print("Config file must be a .toml file")
+        exit(1)
+    elif not os.path.exists(config_file):
+        print("Config file does not exist")
+        exit(1)
+    return toml.load(config_file)
 
 if __name__ == "__main__":
     # if len(sys.argv) < 2:
     #     print("Usage: python3 fizikal_manager.py <config.toml>")
     #     exit(1)
     pd.options.mode.chained_assignment = None 
-    restart_cache()
-    manager = FizikalManager(config_file="config.toml", mock=False)
+    config = load_config("config.toml")
+    if config.get("accounts"):
+        from multi_account_manager import MultiAccountManager
+
+        manager = MultiAccountManager(config=config, mock=False)
+    else:
+        manager = FizikalManager(config=config, mock=False)
     manager.start()
@@ -0,0 +1,350 @@
+from flask import Flask, request, jsonify
+import base64
+import datetime
+import http.server
+import io
+import itertools
+import json
+import random
+import socketserver
+import threading
+import time
+import toml
+import wsgiref.simple_server
+import utils
+from registration_burst import FULL_CLASS, CLASS_NOT_OPEN
+
+DEFAULT_CLASSES = [
+    {"id": 3100, "startTime": "07:00", "endTime": "07:45", "description": "Body Shape"},
+    {"id": 2437, "startTime": "07:45", "endTime": "08:30", "description": "Functional Training"},
+    {"id": 2516, "startTime": "10:00", "endTime": "10:45", "description": "Spin"},
+    {"id": 2890, "startTime": "19:00", "endTime": "19:45", "description": "Pilates"},
+]
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    http_version = "1.1"
+
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    Serves several requests per connection (HTTP/1.1 keep-alive) like the
+    real API does, so pooled client connections are actually reused.
+    The werkzeug dev server closes every connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # loops over handle_one_request until the client closes
+        http.server.BaseHTTPRequestHandler.handle(self)
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        # read the whole body so an unread one doesn't precede the next request
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        handler = KeepAliveServerHandler(
+            io.BytesIO(body), self.wfile, self.get_stderr(), self.get_environ(), multithread=True
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
+DAY_NAMES = ["שני", "שלישי", "רביעי", "חמישי", "שישי", "שבת", "ראשון"]
+
+
+def make_token(ttl: float) -> str:
+    """
+    Unsigned JWT-shaped token carrying an "exp" claim, enough for utils.jwt_expiry
+    """
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+
+    now = int(time.time())
+    payload = {"nbf": now, "iat": now, "exp": now + int(ttl), "jti": random.random()}
+    return f'{encode({"alg": "none", "typ": "JWT"})}.{encode(payload)}.'
+
+
+class FizikalStandIn:
+    """
+    Local stand-in for the Fizikal API, for latency benchmarks and tests.
+    Serves the endpoints the client uses with per-class capacity, registration
+    openings (registration opens opening_lead_hours before a class starts,
+    or at an explicitly set time), access tokens expiring after
+    token_ttl_seconds, added latency and injected errors.
+
+    Config (all optional):
+        latency_ms, latency_jitter_ms, token_ttl_seconds, capacity,
+        initial_participants, opening_lead_hours, error_rate, error_status,
+        classes (list of {id, startTime, endTime, description[, maxParticipants]})
+    """
+
+    def __init__(self, config: dict = {}):
+        self.latency = config.get("latency_ms", 0) / 1000
+        self.latency_jitter = config.get("latency_jitter_ms", 0) / 1000
+        self.token_ttl = config.get("token_ttl_seconds", 600)
+        self.capacity = config.get("capacity", 20)
+        self.initial_participants = config.get("initial_participants", 0)
+        self.opening_lead = datetime.timedelta(hours=config.get("opening_lead_hours", 24))
+        self.error_rate = config.get("error_rate", 0)
+        self.error_status = config.get("error_status", 500)
+        self.schedule = config.get("classes", DEFAULT_CLASSES)
+
+        self.lock = threading.Lock()
+        self.classes = dict()  # (class id, date) -> class dict
+        self.openings = dict()  # (class id, date) -> datetime registration opens
+        self.registrations = dict()  # registration id -> (class id, date)
+        self.registration_ids = itertools.count(791266385)
+        self.access_tokens = dict()  # token -> its "exp" claim
+        self.injected_errors = []  # [endpoint, status, count]
+        self.request_log = []  # (endpoint, status, received_at)
+        self.registration_log = []  # (class id, date, accepted_at, opens_at)
+
+        self.app = self.create_app()
+        self.server = None
+        self.thread = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Serves in a background thread and returns the base URL
+        """
+        self.server = wsgiref.simple_server.make_server(
+            host,
+            port,
+            self.app,
+            server_class=ThreadingWSGIServer,
+            handler_class=KeepAliveRequestHandler,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{host}:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def set_opening(self, class_id: int, class_date: str, opens_at: datetime.datetime):
+        with self.lock:
+            self.get_class(int(class_id), class_date)
+            self.openings[(int(class_id), class_date)] = opens_at
+
+    def set_participants(self, class_id: int, class_date: str, total: int, maximum: int = None):
+        with self.lock:
+            c = self.get_class(int(class_id), class_date)
+            c["totalParticipants"] = total
+            if maximum is not None:
+                c["maxParticipants"] = maximum
+
+    def inject_error(self, endpoint: str, status: int = 500, count: int = 1):
+        """
+        The next count requests to endpoint (a suffix of the path) fail with status
+        """
+        with self.lock:
+            self.injected_errors.append([endpoint, status, count])
+
+    def expire_tokens(self):
+        """
+        Revokes all issued access tokens, so the next authenticated call gets a 401
+        (tokens past their "exp" get one anyway)
+        """
+        with self.lock:
+            self.access_tokens.clear()
+
+    def get_class(self, class_id: int, class_date: str) -> dict:
+        key = (class_id, class_date)
+        if key not in self.classes:
+            template = next((c for c in self.schedule if c["id"] == class_id), None)
+            if template is None:
+                return None
+            date = datetime.date.fromisoformat(class_date)
+            self.classes[key] = {
+                "id": class_id,
+                "contractId": 0,
+                "purchaseId": 0,
+                "day": DAY_NAMES[date.weekday()],
+                "date": date.strftime("%d/%m"),
+                "dateRequest": class_date,
+                "startTime": template["startTime"],
+                "endTime": template["endTime"],
+                "description": template["description"],
+                "instructorName": "",
+                "maxParticipants": template.get("maxParticipants", self.capacity),
+                "totalParticipants": self.initial_participants,
+                "locationName": "",
+                "registrationId": 0,
+                "action": {"text": "הרשמה", "name": "AddRegistration"},
+            }
+        return self.classes[key]
+
+    def opens_at(self, c: dict) -> datetime.datetime:
+        key = (c["id"], c["dateRequest"])
+        if key in self.openings:
+            return self.openings[key]
+        h, m = c["startTime"].split(":")
+        start = datetime.datetime.combine(
+            datetime.date.fromisoformat(c["dateRequest"]),
+            datetime.time(hour=int(h), minute=int(m)),
+        )
+        return start - self.opening_lead
+
+    def set_registered(self, c: dict, registration_id: int):
+        c["registrationId"] = registration_id
+        if registration_id:
+            c["action"] = {"text": "ביטול", "name": "RemoveRegistration"}
+        else:
+            c["action"] = {"text": "הרשמה", "name": "AddRegistration"}
+
+    def create_app(self) -> Flask:
+        app = Flask(__name__)
+        app.json.ensure_ascii = False  # the real API sends the messages as UTF-8
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule("/", "ping", lambda: "", methods=["GET", "HEAD"])
+        app.add_url_rule("/app/v1/login/Authentication", "authentication", self.authentication)
+        app.add_url_rule("/app/v1/login/Verification", "verification", self.verification)
+        app.add_url_rule("/app/v1/login/Token", "token", self.token, methods=["POST"])
+        app.add_url_rule("/app/v1/classes/schedule/view", "schedule", self.schedule_view)
+        app.add_url_rule("/app/v1/classes/registration/add", "add", self.registration_add)
+        app.add_url_rule(
+            "/app/v1/classes/registration/remove", "remove", self.registration_remove, methods=["POST"]
+        )
+        return app
+
+    def before_request(self):
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            for injected in self.injected_errors:
+                if request.path.endswith(injected[0]) and injected[2] > 0:
+                    injected[2] -= 1
+                    return self.fail("Injected error", injected[1])
+        if self.error_rate and random.random() < self.error_rate:
+            return self.fail("Injected error", self.error_status)
+
+    def after_request(self, response):
+        with self.lock:
+            self.request_log.append((request.path, response.status_code, time.time()))
+        return response
+
+    def ok(self, data: dict = None):
+        body = {"success": True, "statusCode": 200}
+        if data is not None:
+            body["data"] = data
+        return jsonify(body)
+
+    def fail(self, message: str, status: int = 200):
+        return jsonify({"success": False, "statusCode": 400, "message": message}), status
+
+    def authorized(self) -> bool:
+        token = request.headers.get("authorization", "").removeprefix("Bearer ")
+        with self.lock:
+            expiry = self.access_tokens.get(token)
+        return expiry is not None and time.time() < expiry
+
+    def issue_access_token(self) -> str:
+        token = make_token(self.token_ttl)
+        with self.lock:
+            self.access_tokens[token] = utils.jwt_expiry(token)
+        return token
+
+    def authentication(self):
+        return self.ok()
+
+    def verification(self):
+        branch_id = int(request.args.get("branchId", 14))
+        company_id = int(request.args.get("companyId", 230))
+        return self.ok(
+            {
+                "accessToken": self.issue_access_token(),
+                "refreshToken": make_token(365 * 24 * 3600),
+                "isRequiredTermForm": False,
+                "branches": [
+                    {
+                        "name": "stand-in",
+                        "loginCustomerId": 1,
+                        "loginCompanyId": company_id,
+                        "loginBranchId": branch_id,
+                        "isSelected": True,
+                    }
+                ],
+            }
+        )
+
+    def token(self):
+        if not request.form.get("refreshToken"):
+            return self.fail("Missing refresh token")
+        return self.ok({"accessToken": self.issue_access_token(), "isRequiredTermForm": False})
+
+    def schedule_view(self):
+        if not self.authorized():
+            return self.fail("Unauthorized", 401)
+        class_date = request.args.get("date", "")[:10]
+        with self.lock:
+            classes = [dict(self.get_class(c["id"], class_date)) for c in self.schedule]
+        return self.ok({"list": classes})
+
+    def registration_add(self):
+        if not self.authorized():
+            return self.fail("Unauthorized", 401)
+        class_id = int(request.args.get("classId", 0))
+        class_date = request.args.get("classDate", "")
+        now = datetime.datetime.now()
+        with self.lock:
+            c = self.get_class(class_id, class_date)
+            if c is None:
+                return self.fail("Class not found")
+            opens_at = self.opens_at(c)
+            if c["registrationId"]:
+                return self.ok({"class": dict(c), "actionStatus": 1})
+            if now < opens_at:
+                return self.fail(f'{CLASS_NOT_OPEN} {opens_at.strftime("%d/%m/%Y %H:%M")}')
+            if c["totalParticipants"] >= c["maxParticipants"]:
+                return self.fail(FULL_CLASS)
+            registration_id = next(self.registration_ids)
+            self.registrations[registration_id] = (class_id, class_date)
+            c["totalParticipants"] += 1
+            self.set_registered(c, registration_id)
+            self.registration_log.append((class_id, class_date, now, opens_at))
+            return self.ok({"class": dict(c), "actionStatus": 1})
+
+    def registration_remove(self):
+        if not self.authorized():
+            return self.fail("Unauthorized", 401)
+        payload = request.get_json(silent=True) or request.form
+        registration_id = int(payload.get("id", 0))
+        with self.lock:
+            key = self.registrations.pop(registration_id, None)
+            if key is None:
+                return self.fail("Registration not found")
+            c = self.get_class(*key)
+            c["totalParticipants"] -= 1
+            self.set_registered(c, 0)
+            return self.ok({"class": dict(c), "actionStatus": 1})
+
+
+def main(config_file: str = "config.toml"):
+    config = toml.load(config_file).get("stand_in", {})
+    stand_in = FizikalStandIn(config)
+    base_url = stand_in.start(config.get("host", "127.0.0.1"), config.get("port", 8081))
+    print(f"Fizikal stand-in serving on {base_url}")
+    stand_in.thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,44 @@
+import logging
+import math
+import re
+import threading
 import pygsheets
+from pygsheets.utils import numericise_all
 import pandas as pd
 
+DATE_SHEET_TITLE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def column_letter(n: int) -> str:
+    """
+    1 -> A, 26 -> Z, 27 -> AA
+    """
+    letters = ""
+    while n > 0:
+        n, remainder = divmod(n - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def cell_text(value) -> str:
+    """
+    A value as the sheet displays it, so frames and sheet contents compare equal
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def row_key(row: pd.DataFrame) -> tuple:
+    """
+    (class id, branch id) of a one-row frame as sheet text; a class id can
+    repeat on a date sheet across branches
+    """
+    branch = row["branchId"].values[0] if "branchId" in row else None
+    return cell_text(row["id"].values[0]), cell_text(branch)
+
 
 class GoogleSheetReaderWriter:
     def __init__(
@@ -9,59 +47,257 @@ class GoogleSheetReaderWriter:
         if not credentials_file:
             raise Exception("GoogleSheetReaderWriter: Credentials file not specified")
         self.spreadsheet_id = spreadsheet_id
-        self.client = pygsheets.authorize(service_file=credentials_file)
+        self.credentials_file = credentials_file
+        self._client = None
+        self._spreadsheet = None
+        self.connect_lock = threading.Lock()
 
-        try:
-            # Attempt to open the spreadsheet by title
-            # self.spreadsheet = self.client.open(self.spreadsheet_name)
-            self.spreadsheet = self.client.open_by_key(self.spreadsheet_id)
-            print(f"Opened spreadsheet: {self.spreadsheet_id} (ID: {self.spreadsheet.id})")
-        except pygsheets.SpreadsheetNotFound:
-            print(f"Spreadsheet '{self.spreadsheet_id}' not found.")
+        # last known contents of each sheet, header row first, as displayed text
+        self.known_values = dict()
+        # sheet_name -> {(class id, branch id) as text: 1-based row number}
+        self.row_index = dict()
 
+    def connect(self):
+        """
+        Authorizes and opens the spreadsheet on first use, so creating the
+        reader-writer makes no network call (the manager's first use is
+        off its event loop)
+        """
+        with self.connect_lock:
+            if self._client is not None:
+                return
+            client = pygsheets.authorize(service_file=self.credentials_file)
+            try:
+                # Attempt to open the spreadsheet by title
+                # self.spreadsheet = self.client.open(self.spreadsheet_name)
+                self._spreadsheet = client.open_by_key(self.spreadsheet_id)
+                print(f"Opened spreadsheet: {self.spreadsheet_id} (ID: {self._spreadsheet.id})")
+            except pygsheets.SpreadsheetNotFound:
+                print(f"Spreadsheet '{self.spreadsheet_id}' not found.")
+            self._client = client
 
+    @property
+    def client(self):
+        self.connect()
+        return self._client
+
+    @property
+    def spreadsheet(self):
+        self.connect()
+        return self._spreadsheet
 
     def write_cells(self, df: pd.DataFrame, sheet_name: str):
-        # Clear the existing content of the worksheet
-        try:
-            worksheet = self.spreadsheet.worksheet_by_title(sheet_name)
-        except pygsheets.exceptions.WorksheetNotFound:
-            worksheet = self.spreadsheet.add_worksheet(sheet_name)
+        self.write_sheets({sheet_name: df})
+
+    def write_sheets(self, frames: dict):
+        """
+        Writes {sheet_name: DataFrame}, sending only the rows that differ from
+        the last known sheet contents in one batch update for the spreadsheet.
+        Rows that disappeared are blanked instead of clearing the sheet.
+        """
+        existing = {worksheet.title for worksheet in self.spreadsheet.worksheets()}
+        for sheet_name in frames:
+            if sheet_name not in existing:
+                self.spreadsheet.add_worksheet(sheet_name)
+                self.set_known_values(sheet_name, [])
+        unknown = [name for name in frames if name not in self.known_values]
+        if unknown:
+            value_ranges = self.client.sheet.values_batch_get(
+                self.spreadsheet.id, [f"'{name}'" for name in unknown]
+            )
+            for name, value_range in zip(unknown, value_ranges):
+                self.set_known_values(
+                    name,
+                    [[cell_text(v) for v in row] for row in value_range.get("values", [])],
+                )
 
-        worksheet.clear()
-        worksheet.set_dataframe(df, "A1")
+        new_values = {name: self.frame_values(df) for name, df in frames.items()}
+        data = []
+        for sheet_name, values in new_values.items():
+            data.extend(
+                self.changed_ranges(sheet_name, self.known_values[sheet_name], values)
+            )
+        if data:
+            self.client.sheet.values_batch_update_by_data_filter(
+                self.spreadsheet.id, data
+            )
+        for sheet_name, values in new_values.items():
+            self.set_known_values(sheet_name, values)
 
-        # Get the headers from the first dictionary in the list
-        # Write the headers to the worksheet
-        # headers = [df.columns.tolist()]
-        # worksheet.update_values('A1', headers)
-        # worksheet.update_values('A2', df.values.tolist())
+    def set_known_values(self, sheet_name: str, values: list):
+        """
+        Records the contents of a sheet and re-indexes its rows by class and branch id
+        """
+        self.known_values[sheet_name] = values
+        rows = self.row_index[sheet_name] = dict()
+        if not values or "id" not in values[0]:
+            return
+        id_col = values[0].index("id")
+        branch_col = values[0].index("branchId") if "branchId" in values[0] else None
+        for rownum, row in enumerate(values[1:], start=2):
+            if id_col < len(row) and row[id_col]:
+                branch = ""
+                if branch_col is not None and branch_col < len(row):
+                    branch = row[branch_col]
+                rows[(row[id_col], branch)] = rownum
+
+    @staticmethod
+    def frame_values(df: pd.DataFrame) -> list:
+        return [[cell_text(v) for v in df.columns]] + [
+            [cell_text(v) for v in row] for row in df.values.tolist()
+        ]
+
+    @staticmethod
+    def changed_ranges(sheet_name: str, old_values: list, new_values: list) -> list:
+        """
+        Batch update entries for the runs of consecutive rows that differ
+        """
+        width = max([len(row) for row in old_values + new_values] + [1])
+        pad = lambda row: row + [""] * (width - len(row))
+        rows = [
+            pad(new_values[i]) if i < len(new_values) else pad([])
+            for i in range(max(len(old_values), len(new_values)))
+        ]
+        changed = [
+            i
+            for i, row in enumerate(rows)
+            if i >= len(old_values) or pad(old_values[i]) != row
+        ]
+
+        data = []
+        start = 0
+        while start < len(changed):
+            end = start
+            while end + 1 < len(changed) and changed[end + 1] == changed[end] + 1:
+                end += 1
+            first, last = changed[start], changed[end]
+            data.append(
+                {
+                    "dataFilter": {
+                        "a1Range": f"'{sheet_name}'!A{first + 1}:{column_letter(width)}{last + 1}"
+                    },
+                    "majorDimension": "ROWS",
+                    "values": rows[first : last + 1],
+                }
+            )
+            start = end + 1
+        return data
 
     def delete_worksheet(self, sheet_name):
         worksheet = self.spreadsheet.worksheet_by_title(sheet_name)
         self.spreadsheet.del_worksheet(worksheet)
+        self.known_values.pop(sheet_name, None)
+        self.row_index.pop(sheet_name, None)
 
 
 
     def update_row(self, row: pd.DataFrame, sheet_name: str):
-        worksheet = self.spreadsheet.worksheet_by_title(sheet_name)
-        cellrow = worksheet.find(
-            str(row["id"].values[0]), matchEntireCell=True
-        )  # get row by id
-        rownum = cellrow[0].row
-        # worksheet.get_values(f'A{rownum}', f'Z{rownum}')
-        last_col = chr(64 + max(row.shape))
-        worksheet.update_values(
-            crange=f"A{rownum}:{last_col}{rownum}",
-            values=[row.values.flatten().tolist()],
-            majordim="ROWS",
+        self.update_rows([(sheet_name, row)])
+
+    def update_rows(self, rows: list):
+        """
+        Writes [(sheet_name, one-row DataFrame)] as one multi-range batch update.
+        Rows whose sheet or class can't be found are logged and skipped, so
+        they don't hold back the others
+        """
+        data, written = [], []
+        for sheet_name, row in rows:
+            key = row_key(row)
+            try:
+                rownum = self.row_number(sheet_name, key)
+            except (pygsheets.WorksheetNotFound, KeyError):
+                logging.log(
+                    logging.ERROR,
+                    f"Dropped the update of class {key[0]}: not found in sheet {sheet_name}",
+                )
+                continue
+            values = [cell_text(v) for v in row.values.flatten().tolist()]
+            data.append(
+                {
+                    "dataFilter": {
+                        "a1Range": f"'{sheet_name}'!A{rownum}:{column_letter(len(values))}{rownum}"
+                    },
+                    "majorDimension": "ROWS",
+                    "values": [values],
+                }
+            )
+            written.append((sheet_name, rownum, values))
+        if data:
+            self.client.sheet.values_batch_update_by_data_filter(
+                self.spreadsheet.id, data
+            )
+        for sheet_name, rownum, values in written:
+            known = self.known_values.get(sheet_name)
+            if known is not None and rownum - 1 < len(known):
+                known[rownum - 1] = values
+
+    def row_number(self, sheet_name: str, key: tuple) -> int:
+        """
+        Sheet row (1-based) of the class with row_key key
+        """
+        rownum = self.row_index.get(sheet_name, {}).get(key)
+        if rownum is None:  # sheet not read or written by us yet, or changed since
+            # re-index the whole sheet: the class id alone may be on the rows of several branches
+            self.spreadsheet.worksheet_by_title(sheet_name)  # WorksheetNotFound
+            (value_range,) = self.client.sheet.values_batch_get(
+                self.spreadsheet.id, [f"'{sheet_name}'"]
+            )
+            self.set_known_values(
+                sheet_name,
+                [[cell_text(v) for v in row] for row in value_range.get("values", [])],
+            )
+            rownum = self.row_index[sheet_name][key]
+        return rownum
+
+    def revision(self) -> str:
+        """
+        Last time the spreadsheet was modified (Drive modifiedTime)
+        """
+        return self.spreadsheet.updated
+
+    def date_worksheets(self):
+        return [
+            worksheet
+            for worksheet in self.spreadsheet.worksheets()
+            if DATE_SHEET_TITLE.match(worksheet.title)
+        ]
+
+    def read_cells(self, columns=None) -> pd.DataFrame:
+        """
+        Reads every date sheet with a single batch request and builds the
+        combined frame once. columns optionally projects the result.
+        """
+        titles = [worksheet.title for worksheet in self.date_worksheets()]
+        if not titles:
+            return pd.DataFrame(columns=columns)
+        value_ranges = self.client.sheet.values_batch_get(
+            self.spreadsheet.id, [f"'{title}'" for title in titles]
         )
+        rows = []
+        for title, value_range in zip(titles, value_ranges):
+            values = value_range.get("values", [])
+            self.set_known_values(title, [[cell_text(v) for v in row] for row in values])
+            rows.extend(self.values_to_records(values, columns))
+        return pd.DataFrame(rows, columns=columns)
 
-    def read_cells(self):
-        df = pd.DataFrame()
-        for worksheet in self.spreadsheet.worksheets():
-            df = pd.concat([df, worksheet.get_as_df()], ignore_index=True)
-        return df
+    @staticmethod
+    def values_to_records(values: list, columns=None) -> list:
+        """
+        Sheet values (header row first) to records, numerized like get_as_df
+        """
+        if not values:
+            return []
+        header = values[0]
+        records = []
+        for row in values[1:]:
+            if not any(row):  # blanked by a diff write
+                continue
+            row = numericise_all(row + [""] * (len(header) - len(row)), "")
+            record = dict(zip(header, row))
+            if columns is not None:
+                record = {c: record.get(c, "") for c in columns}
+            records.append(record)
+        return records
 
 
 def main():
@@ -0,0 +1,197 @@
+import asyncio
+import base64
+import email.utils
+import json
+import re
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl
+import httpx
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from traffic_log import REDACTED, SECRET_PARAMS, redact, redact_headers
+
+# the body is stored decoded, so these no longer describe it on replay
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+# schedule/view sends "date=<today + delta> <time of the call>"
+TIMESTAMP = re.compile(r"^(\d{4}-\d{2}-\d{2}) \d{2}:\d{2}:\d{2}(\.\d+)?$")
+
+
+def normalize_params(params: dict) -> tuple:
+    """
+    Hashable form of the query params for the replay index.
+    Timestamps are cut to their date so calls made at another time of day still match.
+    """
+    normalized = []
+    for key, value in params.items():
+        match = TIMESTAMP.match(value)
+        normalized.append((key, match.group(1) if match else value))
+    return tuple(sorted(normalized))
+
+
+def split_url(url: str) -> tuple:
+    """
+    (path, query params), the phone number and SMS code params redacted as
+    they are in the recordings
+    """
+    parts = urlsplit(str(url))
+    params = {
+        k: (REDACTED if k in SECRET_PARAMS else v) for k, v in parse_qsl(parts.query)
+    }
+    return parts.path or "/", params
+
+
+def placeholder_token(ttl: float = 24 * 60 * 60) -> str:
+    """
+    Unsigned JWT-shaped token valid for ttl seconds, served on replay in
+    place of the redacted tokens
+    """
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+
+    now = int(time.time())
+    payload = {"nbf": now, "iat": now, "exp": now + int(ttl)}
+    return f'{encode({"alg": "none", "typ": "JWT"})}.{encode(payload)}.'
+
+
+class HttpRecorder:
+    """
+    Appends every exchange to a JSON lines file, one object per exchange:
+    sent_at, elapsed, method, endpoint, params, request_body, status, headers, body
+    Tokens, the phone number and the SMS code are redacted like in the
+    traffic log, so recordings can be kept as fixtures.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def record(self, response, sent_at: float, received_at: float):
+        request = response.request
+        endpoint, params = split_url(request.url)
+        body = request.body if hasattr(request, "body") else request.content
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", "replace")
+        line = json.dumps(
+            {
+                "sent_at": sent_at,
+                "elapsed": received_at - sent_at,
+                "method": request.method,
+                "endpoint": endpoint,
+                "params": params,
+                "request_body": redact(body) if isinstance(body, str) else body,
+                "status": response.status_code,
+                "headers": redact_headers(response.headers),
+                "body": redact(response.text),
+            },
+            ensure_ascii=False,
+        )
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HttpReplay:
+    """
+    Recorded exchanges indexed by (method, endpoint, params), falling back to
+    (method, endpoint) when the params weren't recorded. Repeated calls walk
+    through the recordings in order and keep serving the last one.
+    With reproduce_timing the recorded response times are slept.
+    Redacted values in the recorded bodies are served as a placeholder token.
+    """
+
+    def __init__(self, path: str, reproduce_timing: bool = False):
+        self.reproduce_timing = reproduce_timing
+        self.exact = dict()
+        self.fallback = dict()
+        self.cursors = dict()
+        self.lock = threading.Lock()
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    self.add(json.loads(line))
+
+    def add(self, record: dict):
+        method, endpoint = record["method"], record["endpoint"]
+        key = (method, endpoint, normalize_params(record["params"]))
+        self.exact.setdefault(key, []).append(record)
+        self.fallback.setdefault((method, endpoint), []).append(record)
+
+    def lookup(self, method: str, url: str) -> dict:
+        endpoint, params = split_url(url)
+        for index, key in [
+            (self.exact, (method, endpoint, normalize_params(params))),
+            (self.fallback, (method, endpoint)),
+        ]:
+            if key in index:
+                with self.lock:
+                    cursor = self.cursors.get(key, 0)
+                    self.cursors[key] = cursor + 1
+                return index[key][min(cursor, len(index[key]) - 1)]
+        raise Exception(f"HttpReplay: no recording for {method} {endpoint}")
+
+    def response_headers(self, record: dict) -> dict:
+        headers = {
+            k: v for k, v in record["headers"].items() if k.lower() not in DROPPED_HEADERS
+        }
+        for key in headers:
+            if key.lower() == "date":
+                # keep the recorded server clock offset, not the recorded day
+                recorded = email.utils.parsedate_to_datetime(headers[key]).timestamp()
+                offset = recorded - (record["sent_at"] + record["elapsed"])
+                headers[key] = email.utils.formatdate(time.time() + offset, usegmt=True)
+        return headers
+
+    def response_body(self, record: dict) -> bytes:
+        return record["body"].replace(REDACTED, placeholder_token()).encode("utf-8")
+
+    def delay(self, record: dict) -> float:
+        return record["elapsed"] if self.reproduce_timing else 0
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    requests transport adapter serving an HttpReplay
+    """
+
+    def __init__(self, replay: HttpReplay):
+        super().__init__()
+        self.replay = replay
+
+    def send(self, request, **kwargs) -> requests.Response:
+        record = self.replay.lookup(request.method, request.url)
+        time.sleep(self.replay.delay(record))
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.headers = CaseInsensitiveDict(self.replay.response_headers(record))
+        response._content = self.replay.response_body(record)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport serving an HttpReplay
+    """
+
+    def __init__(self, replay: HttpReplay):
+        self.replay = replay
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        record = self.replay.lookup(request.method, str(request.url))
+        await asyncio.sleep(self.replay.delay(record))
+        return httpx.Response(
+            record["status"],
+            headers=self.replay.response_headers(record),
+            content=self.replay.response_body(record),
+            request=request,
+        )
@@ -0,0 +1,110 @@
+import bisect
+import threading
+
+# histogram bucket upper bounds, in ms
+LATENCY_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: list = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list:
+        total, result = 0, []
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile
+        """
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): total for bound, total in self.cumulative()},
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms keyed by name and labels.
+    snapshot() is the in-process view, render() the Prometheus text format
+    served on /metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()  # (name, labels) -> value
+        self.histograms = dict()  # (name, labels) -> Histogram
+
+    def inc(self, name: str, labels: dict = {}, value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = {}):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": {
+                    name + label_text(labels): value
+                    for (name, labels), value in sorted(self.counters.items())
+                },
+                "histograms": {
+                    name + label_text(labels): histogram.snapshot()
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{label_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, total in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f"{name}_bucket{label_text(labels + (('le', le),))} {total}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# process-wide registry the clients, the timer and the manager report to
+registry = MetricsRegistry()
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import time
+from deadline_scheduler import DeadlineScheduler, ScopedScheduler
+from fizikal_http_server import serve_metrics
+from fizikal_manager import FizikalManager, hours2seconds, init_logging, load_config
+
+# account settings overriding the [google_sheets] section
+SHEET_KEYS = ["spreadsheet_id", "sheet_name", "service_account_key"]
+
+
+def account_name(account: dict) -> str:
+    return str(account.get("name", account.get("phone_number")))
+
+
+def account_config(config: dict, account: dict) -> dict:
+    """
+    The config of one [[accounts]] entry: the shared sections with the
+    account's phone number, sheet and its own persistent storage (token cache,
+    HTTP log) under <persistent_storage>/accounts/<name>
+    """
+    phone_number = account.get("phone_number")
+    if not phone_number:
+        raise Exception("MultiAccountManager: phone_number not specified for an account")
+    name = account_name(account)
+    csv_config = config.get("csv", {})
+    csv_root, csv_ext = os.path.splitext(csv_config.get("csv_name", "Fizikal.csv"))
+    return dict(
+        {k: v for k, v in config.items() if k != "accounts"},
+        persistent_storage=os.path.join(
+            config.get("persistent_storage", "./persist"), "accounts", name
+        ),
+        fizikal=dict(config.get("fizikal", {}), phone_number=phone_number),
+        google_sheets=dict(
+            config.get("google_sheets", {}),
+            **{k: account[k] for k in SHEET_KEYS if k in account},
+        ),
+        csv=dict(
+            csv_config,
+            csv_name=account.get("csv_name", f"{csv_root}_{name}{csv_ext}"),
+        ),
+    )
+
+
+class AccountManager(FizikalManager):
+    """
+    One account of a MultiAccountManager: its own token cache, class store
+    and sheet, on the HTTP connections, server clock and scheduler of the pool
+    """
+
+    def __init__(self, pool, name: str, config: dict, mock: bool = False, share_with=None):
+        self.pool = pool
+        self.name = name
+        super().__init__(
+            config=config,
+            mock=mock,
+            share_with=share_with,
+            scheduler=ScopedScheduler(pool.scheduler, name),
+        )
+
+    def _init_logging(self):
+        pass  # the pool logs for every account
+
+    async def calibrate_clock(self):
+        # the accounts share the server clock, one calibration serves them all
+        async with self.pool.calibration_lock:
+            if time.monotonic() - self.pool.calibrated_at < self.pool.min_calibration_interval:
+                return
+            await super().calibrate_clock()
+            self.pool.calibrated_at = time.monotonic()
+
+
+class MultiAccountManager:
+    """
+    Runs several accounts (phone numbers) in one process.
+    The schedule is fetched once and merged into every account's class
+    store, all accounts go through one connection pool, and one scheduler
+    starts the registrations of every account wanting a class at the same
+    opening together.
+
+    config.toml:
+        [[accounts]]
+        name = "nadav"
+        phone_number = "0540000000"
+        sheet_name = "Nadav"  # spreadsheet_id / service_account_key / csv_name too
+    """
+
+    def __init__(self, config_file: str = "config.toml", mock: bool = False, config: dict = None):
+        self.config = config if config is not None else load_config(config_file)
+        self.mock_http = mock
+        self.fizikal_config = self.config.get("fizikal", {})
+        init_logging(self.config.get("persistent_storage", "./persist"))
+
+        self.scheduler = DeadlineScheduler()
+        self.calibration_lock = asyncio.Lock()
+        self.calibrated_at = -float("inf")
+        self.min_calibration_interval = self.fizikal_config.get(
+            "min_clock_calibration_seconds", 60
+        )
+        self.accounts = []
+        for account in self.config.get("accounts", []):
+            config = account_config(self.config, account)
+            self.accounts.append(
+                AccountManager(
+                    self,
+                    account_name(account),
+                    config,
+                    mock=mock,
+                    share_with=self.accounts[0] if self.accounts else None,
+                )
+            )
+        if not self.accounts:
+            raise Exception("MultiAccountManager: No accounts specified in config")
+        logging.log(
+            logging.INFO,
+            f"Accounts initialized: {', '.join(a.name for a in self.accounts)}",
+        )
+
+    async def update_schedule(self):
+        """
+        Fetches the schedule once, through the first account that succeeds,
+        and applies it to every account
+        """
+        for account in self.accounts:
+            try:
+                await account.update_classes_from_sheet()
+            except Exception as e:
+                logging.log(
+                    logging.ERROR,
+                    f"Failed to update classes of {account.name} from sheets. Error: {e}",
+                )
+        schedule = None
+        for account in self.accounts:
+            try:
+                schedule = await account.fetch_schedule()
+                break
+            except Exception as e:
+                logging.log(
+                    logging.ERROR,
+                    f"Failed to get classes as {account.name}. Error: {e}",
+                )
+        if schedule is None:
+            return
+        for account in self.accounts:
+            try:
+                account.apply_schedule(*schedule)
+            except Exception as e:
+                logging.log(
+                    logging.ERROR,
+                    f"Failed to apply the schedule to {account.name}. Error: {e}",
+                )
+
+    async def close(self):
+        for account in self.accounts:
+            await account.close()
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        logging.log(logging.INFO, "Starting scheduler")
+        self.scheduler.every(
+            "update_schedule",
+            hours2seconds(self.fizikal_config.get("get_classes_every_x_hours", 60)),
+            self.update_schedule,
+        )
+        self.scheduler.every(
+            "calibrate_clock", hours2seconds(1), self.accounts[0].calibrate_clock
+        )
+        for account in self.accounts:
+            account.schedule_jobs()
+            self.loop.create_task(account.sheet_writes.run())
+        self.loop.create_task(self.scheduler.run())
+        if self.config.get("metrics_port"):
+            serve_metrics(self.config["metrics_port"])
+            logging.log(logging.INFO, f"Serving /metrics on port {self.config['metrics_port']}")
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.close())
+            self.loop.close()
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+import metrics
+
+
+class PrecisionTimer:
+    """
+    High resolution wait shared by every pending registration.
+    Sleeps coarsely on the event loop, then finishes the last milliseconds
+    against the monotonic clock while still yielding to the other tasks.
+    Records how late each wait fired so the jitter can be measured.
+
+    Targets are in server time: offset_provider returns the current estimate
+    of server minus local clock, in seconds.
+    """
+
+    def __init__(
+        self,
+        coarse_margin: float = 0.05,
+        spin_margin: float = 0.002,
+        history: int = 1000,
+        offset_provider=lambda: 0.0,
+    ):
+        self.offset_provider = offset_provider
+        self.coarse_margin = coarse_margin
+        self.spin_margin = spin_margin
+        self.lateness = deque(maxlen=history)
+
+    def to_monotonic(self, target: datetime.datetime) -> float:
+        local_target = target.timestamp() - self.offset_provider()
+        return time.monotonic() + (local_target - time.time())
+
+    async def wait_until(self, target: datetime.datetime) -> float:
+        """
+        Waits until target (server wall time) and returns the lateness in seconds
+        """
+        remaining = self.to_monotonic(target) - time.monotonic()
+        if remaining > self.coarse_margin:
+            await asyncio.sleep(remaining - self.coarse_margin)
+
+        # re-anchor after the coarse sleep in case the wall clock moved
+        deadline = self.to_monotonic(target)
+        remaining = deadline - time.monotonic()
+        if remaining > self.spin_margin:
+            await asyncio.sleep(remaining - self.spin_margin)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0)
+
+        lateness = time.monotonic() - deadline
+        self.lateness.append(lateness)
+        metrics.registry.observe("fizikal_timer_lateness_ms", 1000 * lateness)
+        return lateness
+
+    async def fire_at(self, target: datetime.datetime, coro_fn, *args):
+        """
+        Waits until target and then awaits coro_fn(*args).
+        Returns (lateness, result)
+        """
+        lateness = await self.wait_until(target)
+        return lateness, await coro_fn(*args)
+
+    def stats(self) -> dict:
+        """
+        Lateness summary in milliseconds
+        """
+        if not self.lateness:
+            return {"count": 0}
+        samples = sorted(self.lateness)
+        percentile = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))]
+        return {
+            "count": len(samples),
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            "p50_ms": 1000 * percentile(0.5),
+            "p99_ms": 1000 * percentile(0.99),
+            "max_ms": 1000 * samples[-1],
+        }
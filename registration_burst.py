@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+from precision_timer import PrecisionTimer
+import metrics
+
+FULL_CLASS = "השיעור התמלא"
+CLASS_NOT_OPEN = "הרשמה לשיעור תיפתח ביום"
+
+SUCCESS = "success"
+FULL = "full"
+NOT_OPEN = "not_open"
+FAILED = "failed"
+
+
+def classify(error: Exception) -> str:
+    message = str(error.args[0]) if error.args else str(error)
+    if FULL_CLASS in message:
+        return FULL
+    elif CLASS_NOT_OPEN in message:
+        return NOT_OPEN
+    return FAILED
+
+
+def burst_offsets(attempts: int, stagger_ms: float, lead_ms: float) -> list:
+    """
+    Attempt offsets (seconds) from the opening: the first one lead_ms early,
+    the next ones stagger_ms apart
+    """
+    return [(i * stagger_ms - lead_ms) / 1000 for i in range(attempts)]
+
+
+class BurstRegistration:
+    """
+    Sends a few staggered registration attempts around the predicted opening
+    instant. The first success or full-class answer settles the burst and
+    cancels the attempts still waiting or in flight.
+    Per-attempt timings are appended to history for tuning the stagger.
+    """
+
+    def __init__(self, timer: PrecisionTimer, offsets: list, history: deque = None):
+        self.timer = timer
+        self.offsets = offsets
+        self.history = history if history is not None else deque(maxlen=1000)
+        self.attempts = []
+
+    async def run(self, opening: datetime.datetime, send) -> tuple:
+        """
+        send(attempt_index) is awaited for each attempt.
+        Returns (outcome, result): the class dict on success, otherwise the
+        last error
+        """
+        attempts = [
+            asyncio.create_task(
+                self.attempt(i, opening + datetime.timedelta(seconds=offset), send)
+            )
+            for i, offset in enumerate(self.offsets)
+        ]
+        outcome, result = FAILED, None
+        try:
+            for finished in asyncio.as_completed(attempts):
+                attempt_outcome, attempt_result = await finished
+                if attempt_outcome in (SUCCESS, FULL):
+                    return attempt_outcome, attempt_result
+                # prefer "not open yet" over other failures, it is worth retrying
+                if outcome != NOT_OPEN:
+                    outcome, result = attempt_outcome, attempt_result
+            return outcome, result
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def attempt(self, index: int, target: datetime.datetime, send) -> tuple:
+        lateness = await self.timer.wait_until(target)
+        sent_at = time.monotonic()
+        try:
+            outcome, result = SUCCESS, await send(index)
+        except Exception as e:
+            outcome, result = classify(e), e
+        timing = {
+            "attempt": index,
+            "offset_ms": 1000 * self.offsets[index],
+            "lateness_ms": 1000 * lateness,
+            "latency_ms": 1000 * (time.monotonic() - sent_at),
+            "outcome": outcome,
+        }
+        self.attempts.append(timing)
+        self.history.append(timing)
+        metrics.registry.inc("fizikal_registration_attempts_total", {"outcome": outcome})
+        return outcome, result
@@ -0,0 +1,246 @@
+import asyncio
+import datetime
+import logging
+import sys
+import threading
+from collections import deque
+from fizikal_api import FizikalAPI
+from fizikal_async_api import AsyncFizikalAPI
+from precision_timer import PrecisionTimer
+from registration_burst import (
+    BurstRegistration,
+    burst_offsets,
+    classify,
+    SUCCESS,
+    FULL,
+    NOT_OPEN,
+)
+
+
+class RegistrationSniper:
+    """
+    The time-critical registration path of one class: waits for the
+    warm-up before the opening, sends the registration burst at the opening
+    and retries within the retry window.
+    """
+
+    def __init__(
+        self,
+        async_api: AsyncFizikalAPI,
+        timer: PrecisionTimer,
+        config: dict = {},
+        history: deque = None,
+    ):
+        self.async_api = async_api
+        self.clock = async_api.api.clock
+        self.timer = timer
+        self.config = config
+        self.history = history if history is not None else deque(maxlen=1000)
+        self.warm = True
+
+    async def register(self, classid, classdate, registration_date, branch_id=None) -> tuple:
+        """
+        Returns (outcome, result): the class dict on success, otherwise the last error.
+        branch_id routes the requests to another branch of the account
+        """
+        api = self.async_api.for_branch(branch_id)
+        warmup_lead = self.config.get("warmup_seconds_before_opening", 45)
+        await asyncio.sleep(
+            max(
+                0,
+                (registration_date - self.clock.server_now()).total_seconds()
+                - warmup_lead,
+            )
+        )
+        offsets = burst_offsets(
+            self.config.get("burst_attempts", 3),
+            self.config.get("burst_stagger_ms", 40),
+            self.config.get("burst_lead_ms", 20),
+        )
+        prepared = await self.warm_up(classid, classdate, len(offsets), api)
+        # held and cancelled here, however the registration ends
+        keep_warm = asyncio.create_task(self.keep_connection_warm(registration_date))
+        try:
+            return await self.fire(
+                classid, classdate, registration_date, api, offsets, prepared
+            )
+        finally:
+            keep_warm.cancel()
+
+    async def fire(
+        self, classid, classdate, registration_date, api, offsets, prepared
+    ) -> tuple:
+        """
+        The burst at the opening and the retries after it
+        """
+        burst = BurstRegistration(self.timer, offsets, self.history)
+        outcome, result = await burst.run(
+            registration_date,
+            lambda i: api.register_class(
+                classid, classdate, prepared=prepared[i]
+            ),
+        )
+        logging.log(logging.INFO, f"Registration burst for {classid} at {classdate}: {burst.attempts}")
+
+        # retry quickly while the class isn't open yet, backing off on other errors
+        retry_interval = self.config.get("registration_retry_seconds", 0.1)
+        max_backoff = self.config.get("registration_retry_max_backoff_seconds", 5)
+        backoff = retry_interval
+        checked = False
+        retry_until = registration_date + datetime.timedelta(
+            seconds=self.config.get("registration_retry_window_seconds", 60)
+        )
+        while outcome not in (SUCCESS, FULL) and self.clock.server_now() < retry_until:
+            if outcome == NOT_OPEN:
+                await asyncio.sleep(retry_interval)
+            else:
+                if not checked:
+                    # "already registered" and errors of attempts that went
+                    # through look like any failure, the schedule tells
+                    checked = True
+                    registered = await self.find_server_registration(classid, classdate, api)
+                    if registered is not None:
+                        return SUCCESS, registered
+                backoff = min(2 * backoff, max_backoff)
+                left = (retry_until - self.clock.server_now()).total_seconds()
+                await asyncio.sleep(max(0, min(backoff, left)))
+            try:
+                outcome, result = SUCCESS, await api.register_class(
+                    classid, classdate
+                )
+            except Exception as e:  # Failed to registrate
+                outcome, result = classify(e), e
+
+        if outcome not in (SUCCESS, FULL, NOT_OPEN):
+            # an attempt may have gone through even though we got an error back
+            registered = await self.find_server_registration(classid, classdate, api)
+            if registered is not None:
+                outcome, result = SUCCESS, registered
+        return outcome, result
+
+    async def find_server_registration(self, classid, classdate, api=None):
+        """
+        Returns the schedule entry of the class if the server shows us as
+        registered to it, otherwise None
+        """
+        api = api or self.async_api
+        delta = (
+            datetime.date(*[int(d) for d in classdate.split("-")])
+            - datetime.date.today()
+        ).days
+        try:
+            classes = await api.get_classes(delta)
+        except Exception as e:
+            logging.log(logging.ERROR, f"Failed to check registration. Error: {e}")
+            return None
+        for c in classes:
+            if c.get("id") == classid and c.get("dateRequest", classdate) == classdate:
+                action = c.get("action") or {}
+                if c.get("registrationId") or action.get("name") == "RemoveRegistration":
+                    return c
+        return None
+
+    async def warm_up(self, classid, classdate, attempts=1, api=None):
+        """
+        Runs shortly before an opening: makes sure the access token outlives
+        it, opens a connection to the API host and pre-builds one registration
+        request per burst attempt
+        """
+        api = api or self.async_api
+        if not self.warm:
+            return [None] * attempts
+        try:
+            # valid through the opening and its retries
+            await api.tokens.ensure_fresh(
+                min_validity=self.config.get("warmup_seconds_before_opening", 45)
+                + api.tokens.refresh_margin
+            )
+            await api.preconnect()
+        except Exception as e:
+            logging.log(logging.ERROR, f"Failed to warm up registration. Error: {e}")
+        return [
+            api.prepare_register_class(classid, classdate)
+            for _ in range(attempts)
+        ]
+
+    async def keep_connection_warm(self, registration_date):
+        """
+        Pings the API host until shortly before the opening so the pooled
+        connection is still open at T-0
+        """
+        interval = self.config.get("keepalive_ping_seconds", 15)
+        while (registration_date - self.clock.server_now()).total_seconds() > interval:
+            await asyncio.sleep(interval)
+            try:
+                await self.async_api.preconnect()
+            except Exception as e:
+                logging.log(logging.ERROR, f"Keep-alive ping failed. Error: {e}")
+
+
+class RegistrationWorker:
+    """
+    Runs RegistrationSnipers on their own event loop in a separate thread, so
+    blocking Sheets calls and pandas work on the manager's loop can't delay
+    a registration. One worker and its HTTP client serve every account of
+    the process; each account's sniper() shares the token cache and the
+    server clock estimate of that account's FizikalAPI.
+
+    register() is awaited on the manager's loop: the opening is handed to the
+    worker loop's queue and the outcome comes back through the returned
+    future. Cancelling it cancels the registration on the worker.
+    """
+
+    def __init__(self, api: FizikalAPI, switch_interval: float = 0.001):
+        self.api = api  # whose config sets up the HTTP client
+        # a shorter GIL switch interval bounds how long the manager's thread
+        # can hold the worker off. It applies to every thread of the process,
+        # so the previous one is restored by stop()
+        self.previous_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(switch_interval)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="registration-worker", daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.async_api = AsyncFizikalAPI(self.api)
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.async_api.aclose())
+            self.loop.close()
+
+    def sniper(self, api: FizikalAPI, config: dict = {}, history: deque = None):
+        """
+        RegistrationSniper of the account of api on the worker's HTTP client,
+        for register()
+        """
+        return RegistrationSniper(
+            AsyncFizikalAPI(api, client=self.async_api.client),
+            PrecisionTimer(offset_provider=lambda: api.clock.offset),
+            config,
+            history,
+        )
+
+    async def register(
+        self, sniper, classid, classdate, registration_date, branch_id=None
+    ) -> tuple:
+        future = asyncio.run_coroutine_threadsafe(
+            sniper.register(classid, classdate, registration_date, branch_id),
+            self.loop,
+        )
+        return await asyncio.wrap_future(future)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        sys.setswitchinterval(self.previous_switch_interval)
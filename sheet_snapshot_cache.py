@@ -0,0 +1,63 @@
+import asyncio
+import time
+import pandas as pd
+from google_sheets_reader_writer import GoogleSheetReaderWriter
+
+
+class SheetSnapshotCache:
+    """
+    Shared snapshot of the spreadsheet for the periodic loops.
+    The sheets are only re-read when the spreadsheet revision (its Drive
+    modified time) changed, and callers in the same tick share one
+    in-flight read. When the revision can't be fetched every check
+    re-reads and a content hash stands in for the revision.
+    """
+
+    def __init__(
+        self,
+        reader_writer: GoogleSheetReaderWriter,
+        columns=None,
+        min_check_interval: float = 5,
+    ):
+        self.reader_writer = reader_writer
+        self.columns = columns
+        self.min_check_interval = min_check_interval
+        self.snapshot = None
+        self.revision = None
+        self.checked_at = 0.0
+        self.in_flight = None
+
+    async def read(self) -> tuple:
+        """
+        Returns (revision, DataFrame) of the current sheet contents
+        """
+        if (
+            self.snapshot is not None
+            and time.monotonic() - self.checked_at < self.min_check_interval
+        ):
+            return self.revision, self.snapshot
+        if self.in_flight is None:
+            self.in_flight = asyncio.ensure_future(self._refresh())
+        # shielded so a cancelled caller doesn't cancel the shared read
+        return await asyncio.shield(self.in_flight)
+
+    async def _refresh(self) -> tuple:
+        try:
+            try:
+                revision = await asyncio.to_thread(self.reader_writer.revision)
+            except Exception:
+                revision = None
+            if self.snapshot is None or revision is None or revision != self.revision:
+                snapshot = await asyncio.to_thread(
+                    self.reader_writer.read_cells, self.columns
+                )
+                if revision is None:
+                    revision = str(pd.util.hash_pandas_object(snapshot).sum())
+                self.snapshot, self.revision = snapshot, revision
+            self.checked_at = time.monotonic()
+            return self.revision, self.snapshot
+        finally:
+            self.in_flight = None
+
+    def invalidate(self):
+        self.checked_at = 0.0
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from collections import deque
+import pandas as pd
+from google_sheets_reader_writer import GoogleSheetReaderWriter, row_key
+
+
+class SheetWriteQueue:
+    """
+    Write-behind queue in front of GoogleSheetReaderWriter row updates.
+    Updates to the same row are merged, and the queue is flushed as one
+    multi-range batch update every flush_interval seconds or once
+    max_pending rows are waiting. Flushes stay under the Sheets per-minute
+    write quota, and close() drains whatever is left.
+    """
+
+    def __init__(
+        self,
+        reader_writer: GoogleSheetReaderWriter,
+        flush_interval: float = 2,
+        max_pending: int = 50,
+        max_writes_per_minute: int = 50,
+    ):
+        self.reader_writer = reader_writer
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_writes_per_minute = max_writes_per_minute
+        self.pending = dict()  # (sheet_name, (class id, branch id)) -> one-row DataFrame
+        self.write_times = deque()
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.closed = False
+
+    def enqueue(self, row: pd.DataFrame, sheet_name: str):
+        self.pending[(sheet_name, row_key(row))] = row
+        if len(self.pending) >= self.max_pending:
+            self.wakeup.set()
+
+    def pending_rows(self) -> list:
+        return list(self.pending.values())
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            await self.wait_for_quota()
+            batch, self.pending = self.pending, dict()
+            try:
+                await asyncio.to_thread(
+                    self.reader_writer.update_rows,
+                    [(sheet_name, row) for (sheet_name, _), row in batch.items()],
+                )
+            except Exception as e:
+                logging.log(logging.ERROR, f"Failed to flush sheet updates. Error: {e}")
+                # retry later, unless a newer update for the row arrived meanwhile
+                for key, row in batch.items():
+                    self.pending.setdefault(key, row)
+
+    async def wait_for_quota(self):
+        while len(self.write_times) >= self.max_writes_per_minute:
+            wait = self.write_times[0] + 60 - time.monotonic()
+            if wait <= 0:
+                self.write_times.popleft()
+            else:
+                await asyncio.sleep(wait)
+        self.write_times.append(time.monotonic())
+
+    async def close(self, attempts: int = 3):
+        """
+        Stops the flush loop and drains the pending updates
+        """
+        self.closed = True
+        self.wakeup.set()
+        for _ in range(attempts):
+            if not self.pending:
+                break
+            await self.flush()
@@ -0,0 +1,260 @@
+import contextlib
+import datetime
+import glob
+import json
+import os
+import re
+import shelve
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS classes (
+    id INTEGER NOT NULL,
+    dateRequest TEXT NOT NULL,
+    branchId INTEGER NOT NULL,
+    description TEXT,
+    startTime TEXT,
+    endTime TEXT,
+    registered TEXT NOT NULL,
+    registrationId INTEGER NOT NULL,
+    PRIMARY KEY (id, dateRequest, branchId)
+);
+CREATE INDEX IF NOT EXISTS classes_registered ON classes (registered);
+CREATE INDEX IF NOT EXISTS classes_registration_id ON classes (registrationId);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER NOT NULL,
+    dateRequest TEXT NOT NULL,
+    branchId INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    opening TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (id, dateRequest, branchId)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+"""
+CLASS_COLS = [
+    "id",
+    "dateRequest",
+    "branchId",
+    "description",
+    "startTime",
+    "endTime",
+    "registered",
+    "registrationId",
+]
+# branchId is part of the primary key, which can't hold NULL for "the branch of the config"
+NO_BRANCH = 0
+
+
+def _branch(branch_id) -> int:
+    return NO_BRANCH if branch_id is None else branch_id
+
+
+def _key(row) -> tuple:
+    return (row["id"], row["dateRequest"], row["branchId"] or None)
+
+
+class StateStore:
+    """
+    Local SQLite (WAL mode) state of one account, kept across restarts:
+    the token cache (a key-value namespace), the class schedule with the
+    wanted and actual registrations, and the state of registration tasks.
+    One connection shared by the manager and the registration worker
+    thread; every access holds the lock, and transaction() groups writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # with WAL, a crash can only lose the last commits, never corrupt the file
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Groups the writes inside into one commit; nested use joins the outer one
+        """
+        with self.lock:
+            outer = not self.db.in_transaction
+            if outer:
+                self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                if outer:
+                    self.db.execute("ROLLBACK")
+                raise
+            if outer:
+                self.db.execute("COMMIT")
+
+    def execute(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    # key-value
+
+    def cache(self, namespace: str) -> "KeyValueCache":
+        return KeyValueCache(self, namespace)
+
+    def import_shelve(self, namespace: str, pattern: str):
+        """
+        One-time import of the newest shelve file matching pattern (the
+        daily token caches this store replaces)
+        """
+        files = sorted(glob.glob(pattern), key=os.path.getmtime)
+        if not files:
+            return
+        # some dbm backends add their own suffixes to the shelve name
+        path = re.sub(r"\.(db|dat|dir|bak)$", "", files[-1])
+        with shelve.open(path, flag="r") as old, self.transaction():
+            cache = self.cache(namespace)
+            for key in old:
+                if key not in cache:
+                    cache[key] = old[key]
+
+    # classes
+
+    def load_classes(self) -> list:
+        """
+        Every stored class as a dict of CLASS_COLS, branchId None for the config's branch
+        """
+        rows = self.execute(f"SELECT {', '.join(CLASS_COLS)} FROM classes")
+        return [dict(row, branchId=row["branchId"] or None) for row in rows]
+
+    def put_class(self, record):
+        values = [getattr(record, c) for c in CLASS_COLS]
+        values[CLASS_COLS.index("branchId")] = _branch(record.branchId)
+        self.execute(
+            f"INSERT OR REPLACE INTO classes ({', '.join(CLASS_COLS)}) "
+            f"VALUES ({', '.join('?' * len(CLASS_COLS))})",
+            values,
+        )
+
+    def delete_class(self, key: tuple):
+        classid, classdate, branch_id = key
+        self.execute(
+            "DELETE FROM classes WHERE id = ? AND dateRequest = ? AND branchId = ?",
+            (classid, classdate, _branch(branch_id)),
+        )
+
+    def delete_classes(self):
+        self.execute("DELETE FROM classes")
+
+    def set_registration(self, key: tuple, registered: str, registration_id: int):
+        classid, classdate, branch_id = key
+        self.execute(
+            "UPDATE classes SET registered = ?, registrationId = ? "
+            "WHERE id = ? AND dateRequest = ? AND branchId = ?",
+            (registered, registration_id, classid, classdate, _branch(branch_id)),
+        )
+
+    # registration tasks
+
+    def set_task(self, key: tuple, state: str, opening: datetime.datetime = None):
+        classid, classdate, branch_id = key
+        self.execute(
+            "INSERT INTO tasks (id, dateRequest, branchId, state, opening, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id, dateRequest, branchId) DO UPDATE SET "
+            "state = excluded.state, opening = COALESCE(excluded.opening, opening), "
+            "updated_at = excluded.updated_at",
+            (
+                classid,
+                classdate,
+                _branch(branch_id),
+                state,
+                opening.isoformat() if opening is not None else None,
+                datetime.datetime.now().isoformat(),
+            ),
+        )
+
+    def delete_task(self, key: tuple):
+        classid, classdate, branch_id = key
+        self.execute(
+            "DELETE FROM tasks WHERE id = ? AND dateRequest = ? AND branchId = ?",
+            (classid, classdate, _branch(branch_id)),
+        )
+
+    def prune_tasks(self, before: datetime.datetime):
+        """
+        Forgets the finished tasks of openings before before
+        """
+        self.execute(
+            "DELETE FROM tasks WHERE opening < ? AND state NOT IN ('scheduled', 'registering')",
+            (before.isoformat(),),
+        )
+
+    def tasks(self, state: str = None) -> dict:
+        """
+        {key: (state, opening)} of the registration tasks, optionally of one state
+        """
+        sql = "SELECT id, dateRequest, branchId, state, opening FROM tasks"
+        rows = self.execute(sql + " WHERE state = ?", (state,)) if state else self.execute(sql)
+        return {
+            _key(row): (
+                row["state"],
+                datetime.datetime.fromisoformat(row["opening"]) if row["opening"] else None,
+            )
+            for row in rows
+        }
+
+
+class KeyValueCache(MutableMapping):
+    """
+    dict-like view of one namespace of the kv table, values stored as JSON
+    """
+
+    def __init__(self, store: StateStore, namespace: str):
+        self.store = store
+        self.namespace = namespace
+
+    def __getitem__(self, key):
+        rows = self.store.execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ?", (self.namespace, key)
+        )
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0]["value"])
+
+    def __setitem__(self, key, value):
+        self.store.execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+            (self.namespace, key, json.dumps(value)),
+        )
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.store.execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ?", (self.namespace, key)
+        )
+
+    def __iter__(self):
+        rows = self.store.execute(
+            "SELECT key FROM kv WHERE namespace = ?", (self.namespace,)
+        )
+        return iter([row["key"] for row in rows])
+
+    def __len__(self):
+        return self.store.execute(
+            "SELECT COUNT(*) FROM kv WHERE namespace = ?", (self.namespace,)
+        )[0][0]
+
+    def clear(self):
+        self.store.execute("DELETE FROM kv WHERE namespace = ?", (self.namespace,))
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import utils
+
+
+class TokenManager:
+    """
+    Keeps the cached access token valid ahead of its JWT expiry.
+    Refreshes run in the background refresh_margin seconds before "exp",
+    and concurrent callers that need a refresh share one in-flight renewal.
+    The manager's loop and the registration worker's each have a
+    TokenManager on the same cached token; the account's renew_lock lets only
+    one of them renew it, the other then finds the token already replaced.
+    """
+
+    def __init__(self, async_api, refresh_margin: float = 60):
+        self.async_api = async_api
+        self.refresh_margin = refresh_margin
+        self.in_flight = None
+
+    @property
+    def cache(self):
+        return self.async_api.api.cache
+
+    def seconds_left(self) -> float:
+        """
+        Seconds until the cached access token expires; 0 if there is none
+        and None if its expiry can't be decoded
+        """
+        if not "access_token" in self.cache:
+            return 0
+        expiry = utils.jwt_expiry(self.cache["access_token"])
+        return None if expiry is None else expiry - time.time()
+
+    def needs_refresh(self, min_validity: float = 0) -> bool:
+        seconds_left = self.seconds_left()
+        return seconds_left is not None and seconds_left <= min_validity
+
+    async def ensure_fresh(self, min_validity: float = 0):
+        """
+        Makes sure the token is valid for at least min_validity more seconds
+        """
+        if self.needs_refresh(min_validity):
+            await self.refresh()
+
+    async def refresh(self, stale_token: str = None):
+        """
+        Renews the access token, joining a renewal already in flight.
+        With stale_token, nothing is done if the cached token already
+        changed since it was used (another caller renewed it).
+        """
+        token = self.cache.get("access_token")
+        if stale_token is not None and token != stale_token:
+            return
+        if self.in_flight is None:
+            self.in_flight = asyncio.ensure_future(self._renew(token))
+        # shielded so a cancelled caller doesn't cancel the shared renewal
+        await asyncio.shield(self.in_flight)
+
+    async def _renew(self, token: str):
+        renew_lock = self.async_api.api.renew_lock
+        try:
+            # polled rather than waited for in a thread, which would keep the
+            # lock if the renewal got cancelled meanwhile
+            while not renew_lock.acquire(blocking=False):
+                await asyncio.sleep(0.01)
+            try:
+                # unless the other thread renewed it while we waited
+                if self.cache.get("access_token") == token:
+                    await self.async_api.renew_access_token()
+            finally:
+                renew_lock.release()
+        finally:
+            self.in_flight = None
+
+    async def refresh_due(self) -> float:
+        """
+        Refreshes the token if it is within refresh_margin of expiring and
+        returns the seconds until it should be looked at again
+        """
+        try:
+            await self.ensure_fresh(self.refresh_margin)
+            seconds_left = self.seconds_left()
+            if seconds_left is None:  # opaque token, fall back to the 401 path
+                return 5 * 60
+            return max(1, seconds_left - self.refresh_margin)
+        except Exception as e:
+            logging.log(logging.ERROR, f"Failed to refresh access token. Error: {e}")
+            return 30
@@ -0,0 +1,159 @@
+import datetime
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+REDACTED = "<redacted>"
+SECRET_HEADERS = {"authorization", "cookie", "set-cookie"}
+# query params carrying the phone number or the SMS code
+SECRET_PARAMS = {"value", "verificationCode"}
+SECRET_FIELDS = re.compile(
+    r"""((?:refreshToken|accessToken|verificationCode)["']?\s*[:=]\s*["']?)[^"'&,}\s]+"""
+)
+JWT = re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*")
+
+# "full": headers and bodies, "headers": no bodies, "summary": one line, "off": nothing
+VERBOSITY_LEVELS = ["off", "summary", "headers", "full"]
+DEFAULT_VERBOSITY = {"/app/v1/classes/schedule/view": "summary"}
+
+
+def redact(text: str) -> str:
+    return JWT.sub(REDACTED, SECRET_FIELDS.sub(r"\1" + REDACTED, text))
+
+
+def redact_url(url: str) -> str:
+    parts = urlsplit(url)
+    params = [
+        (k, REDACTED if k in SECRET_PARAMS else v) for k, v in parse_qsl(parts.query)
+    ]
+    return urlunsplit(parts._replace(query=urlencode(params, safe="<>")))
+
+
+def redact_headers(headers) -> dict:
+    return {
+        k: (REDACTED if k.lower() in SECRET_HEADERS else redact(v))
+        for k, v in dict(headers).items()
+    }
+
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates once the file exceeds max_bytes or is older than max_age seconds,
+    gzipping the rotated files
+    """
+
+    def __init__(self, filename: str, max_bytes: int, max_age: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.max_age = max_age
+        self.opened_at = time.time()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+
+    @staticmethod
+    def compress(source: str, dest: str):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record) -> bool:
+        if super().shouldRollover(record):
+            return True
+        return (
+            time.time() - self.opened_at >= self.max_age
+            and self.stream is not None
+            and self.stream.tell() > 0
+        )
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+class TrafficLog:
+    """
+    HTTP traffic log written by a background thread.
+    log() only queues the exchange; formatting, redaction of tokens and
+    login secrets, writing and rotation happen on the writer thread.
+    verbosity maps an endpoint (path suffix) to one of VERBOSITY_LEVELS.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_age: float = 24 * 60 * 60,
+        backup_count: int = 10,
+        verbosity: dict = {},
+    ):
+        self.verbosity = dict(DEFAULT_VERBOSITY, **verbosity)
+        for endpoint, level in self.verbosity.items():
+            if level not in VERBOSITY_LEVELS:
+                raise Exception(f"TrafficLog: unknown verbosity {level} for {endpoint}")
+        self.handler = GzipRotatingFileHandler(path, max_bytes, max_age, backup_count)
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def log(self, response, sent_at: float = None, received_at: float = None):
+        self.queue.put((response, sent_at, received_at))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                entry = self.format(*item)
+                if entry:
+                    self.handler.emit(logging.makeLogRecord({"msg": entry}))
+            except Exception as e:
+                logging.log(logging.ERROR, f"Failed to write HTTP traffic log. Error: {e}")
+
+    def level_for(self, path: str) -> str:
+        for endpoint, level in self.verbosity.items():
+            if path.endswith(endpoint):
+                return level
+        return "full"
+
+    def format(self, response, sent_at, received_at) -> str:
+        request = response.request
+        url = str(request.url)
+        level = self.level_for(urlsplit(url).path)
+        if level == "off":
+            return ""
+
+        timing = ""
+        if sent_at is not None and received_at is not None:
+            timing = f" {(received_at - sent_at) * 1000:.1f} ms"
+        sent = datetime.datetime.fromtimestamp(sent_at or time.time()).isoformat()
+        lines = [
+            f"{sent} {request.method} {redact_url(url)} -> {response.status_code}{timing} {len(response.content)} bytes"
+        ]
+        if level in ("headers", "full"):
+            lines.append(f"{redact_headers(request.headers)}")
+        if level == "full":
+            body = request.body if hasattr(request, "body") else request.content
+            if isinstance(body, bytes):
+                body = body.decode("utf-8", "replace")
+            lines.append(redact(f"{body}"))
+        if level in ("headers", "full"):
+            lines.append(f"{redact_headers(response.headers)}")
+        if level == "full":
+            lines.append(redact(response.text))
+        # the handler ends every entry with a newline, full entries get a blank line after
+        return "\n".join(lines) + ("" if level == "summary" else "\n")
+
+    def close(self):
+        """
+        Writes what is still queued and closes the file
+        """
+        self.queue.put(None)
+        self.writer.join()
+        self.handler.close()
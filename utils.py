@@ -1,4 +1,6 @@
 import random, string
+import base64
+import json
 
 
 def generate_device_id() -> str:
@@ -9,3 +11,16 @@ def generate_device_id() -> str:
     return "".join(
         random.choice(string.ascii_lowercase + string.digits) for _ in range(16)
     )
+
+
+def jwt_expiry(token: str) -> float:
+    """
+    Returns the "exp" claim (epoch seconds) of a JWT, or None if it can't be decoded.
+    The signature is not verified.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None